@@ -7,18 +7,25 @@
 # As of 2012-03-19 this means it needs to be directly pulled from the
 # repo at http://bitbucket.org/durin42/hg-git/ .
 #
-# If GNU parallel is present, certain operations will be parallelized.
-# If notify-send is present, the script will send notifications that
-# certain long segments of the operation have been completed.
+# The SPKGs are unpacked by a pool of jobs (by default one per CPU,
+# see -j), largest first, then all of their hg repos are converted in
+# one hg-fast-export.py and git-fast-import session, their trailing
+# whitespace stripped by the pool again, each in a repo of its own,
+# and the results fetched into the consolidated repo. If GNU parallel is present, it runs
+# the pool. If notify-send is present, the script will send
+# notifications that certain long segments of the operation have been
+# completed.
 #
 # Usage:
 #
-#   consolidate-repos.sh -i sagedir -o outdir -t tmpdir
+#   consolidate-repos.sh -i sagedir -o outdir -t tmpdir [-j jobs]
 #
 # Output:
 #
 # - A consolidated repo in outdir
 # - tarballs for the source files in outdir/$SAGE_TARBALLS/
+# - a log per SPKG in outdir/spkg-logs/ and the time each SPKG took in
+#   outdir/spkg-times.txt
 
 . ${0%consolidate-repos.sh}configuration.sh
 
@@ -30,15 +37,17 @@ die () {
 }
 
 usage () {
-    echo "usage: $CMD -i sagedir -o outdir -t tmpdir"
+    echo "usage: $CMD -i sagedir -o outdir -t tmpdir [-j jobs]"
 }
 
 # parse command line options
-while getopts "i:o:t:" opt ; do
+JOBS=$(nproc 2>/dev/null || echo 1)
+while getopts "i:o:t:j:" opt ; do
     case $opt in
         i) SAGEDIR=$(readlink -f "$OPTARG") ;;
         o) OUTDIR=$(readlink -f "$OPTARG") ;;
         t) TMPDIR=$(readlink -f "$OPTARG") ;;
+        j) JOBS="$OPTARG" ;;
     esac
 done
 shift $((OPTIND-1))
@@ -58,6 +67,8 @@ fi
         MADETMP=yes && echo "Created directory $TMPDIR"
 
 export SAGEDIR OUTDIR TMPDIR
+# the SPKG jobs may run in new shells
+export WORKFLOW_DIR $SAGE_CONSTANTS
 
 mkdir -p "$TMPDIR" && cd "$TMPDIR" && rm -rf *
 
@@ -72,8 +83,32 @@ cp "$SAGEDIR"/spkg/base/*.tar* "$OUTDIR"/$SAGE_TARBALLS
 
 # get the SPKG repos converted to git and pull them into the consolidated repo
 # also tarball the src/ directories of the SPKGs and put them into a $SAGE_TARBALLS/ directory
+# "$TMPDIR"/spkg-git/$PKGNAME keeps what is known about each SPKG, and
+# "$TMPDIR"/spkg-repo is the repo all of them are converted into and
+# "$TMPDIR"/spkg-filter/$PKGNAME the one its whitespace is stripped in
 mkdir -p "$TMPDIR"/spkg-git
 
+# print the rules hg-fast-export.py maps the paths of the SPKG's repo
+# with, depending on where it goes in the consolidated repo
+path-rules () {
+    REPO=$1
+    if [ "$REPO" == "." ]; then
+        echo "re:^spkg/bin=$SAGE_SCRIPTS_DIR"
+        echo "re:^spkg=$SAGE_BUILD"
+    elif [ "$REPO" == "$SAGE_EXTDIR" ]; then
+        echo "move:=$REPO"
+        echo 'drop:~$'
+        echo "re:^$REPO/sage/ext/mac-app=$SAGE_MACAPP"
+    elif [ "$REPO" == "$SAGE_SRC" ]; then
+        echo 'drop:\.tar|(~|\.zip|\.spkg)$'
+        echo "move:=$REPO"
+    else
+        echo 'drop:^src|\.tar|(~|\.zip|\.spkg)$'
+        echo "move:=$REPO"
+    fi
+}
+export -f path-rules
+
 process-spkg () {
     # figure out what the spkg is
     SPKGPATH=$1
@@ -97,7 +132,7 @@ process-spkg () {
         return 0
     fi
     
-    TAGS_SWITCH=''
+    TAGS_SWITCH='--no-tags'
     case $PKGNAME in
         sage_root)
             REPO=.
@@ -106,7 +141,7 @@ process-spkg () {
         sage)
             REPO=$SAGE_SRC
             BRANCH=library
-            TAGS_SWITCH='--tag-name-filter cat'
+            TAGS_SWITCH=''
         ;;
         sage_scripts)
             REPO=$SAGE_SCRIPTS_DIR
@@ -137,83 +172,143 @@ process-spkg () {
     esac
     popd > /dev/null
 
-    # convert the SPKG's hg repo to git
-    git init --bare "$TMPDIR"/spkg-git/$PKGNAME
-    pushd "$TMPDIR"/spkg-git/$PKGNAME > /dev/null
-    $WORKFLOW_DIR/fast-export/hg-fast-export.sh -r "$TMPDIR"/spkg/$SPKG -M master
-    rm -rf "$TMPDIR"/spkg/$SPKG
-
-    # rewrite paths
-    # hacked into git-filter-branch so that we can use a bash array across
-    # commits (bash does not support exporting arrays)
-    export REPO SAGE_BUILD SAGE_MACAPP SAGE_SCRIPTS_DIR SAGE_EXTDIR
-    $WORKFLOW_DIR/git-filter-branch -f -d "$TMPDIR/filter-branch/$SPKG" --prune-empty --index-filter '' $TAGS_SWITCH master
-    popd > /dev/null
-
-    if [ -n "$TAGS_SWITCH" ]; then
-        TAGS_SWITCH=''
-    else
-        TAGS_SWITCH='-n'
-    fi
-    # pull it into the consolidated repo
-    git fetch $TAGS_SWITCH "$TMPDIR"/spkg-git/$PKGNAME master:$BRANCH &&
-        rm -rf "$TMPDIR"/spkg-git/$PKGNAME
-
-    # save the package version for later
+    # have the SPKG's hg repo converted to git with the others, its
+    # branch in namespace $PKGNAME, moving its files to where they go in
+    # the consolidated repo and dropping the commits left empty
     mkdir -p "$TMPDIR"/spkg-git/$PKGNAME
+    path-rules "$REPO" > "$TMPDIR"/spkg/$SPKG.rules
+    echo "$TMPDIR/spkg/$SPKG $TMPDIR/spkg-git/$PKGNAME/hg2git -o $PKGNAME" \
+        "--path-rules $TMPDIR/spkg/$SPKG.rules $TAGS_SWITCH" \
+        > "$TMPDIR"/spkg-git/$PKGNAME/manifest
+
+    # save the branch it goes to and the package version for later
+    echo "$BRANCH" > "$TMPDIR"/spkg-git/$PKGNAME/branch.txt
     echo "$PKGVER" > "$TMPDIR"/spkg-git/$PKGNAME/spkg-version.txt
 }
 export -f process-spkg
 
-for SPKGPATH in "$SAGEDIR"/spkg/*/*.spkg ; do
-    process-spkg "$SPKGPATH"
+# run process-spkg with its output in a log of its own, and record how
+# long it took
+process-spkg-logged () {
+    local SPKGPATH=$1 START STATUS
+    local LOG="$OUTDIR"/spkg-logs/$(basename "$SPKGPATH" .spkg).log
+    START=$(date +%s)
+    process-spkg "$SPKGPATH" > "$LOG" 2>&1
+    STATUS=$?
+    echo "$(( $(date +%s) - START )) $STATUS $(stat -c %s "$SPKGPATH")" \
+        "${SPKGPATH#$SAGEDIR/spkg/}" >> "$OUTDIR"/spkg-times.txt
+    echo "${SPKGPATH#$SAGEDIR/spkg/} done, status $STATUS"
+    return $STATUS
+}
+export -f process-spkg-logged
+
+# largest SPKGs first, so that no big one starts when all else is done
+spkgs-by-size () {
+    stat -c '%s %n' "$SAGEDIR"/spkg/*/*.spkg | sort -rn | cut -d' ' -f2-
+}
+
+# strip trailing whitespace from the converted branch of an SPKG, in a
+# repo of its own sharing the objects of the one all were converted
+# into, so that the jobs do not race for refs/original and packed-refs
+# hacked into git-filter-branch so that we can use a bash array across
+# commits (bash does not support exporting arrays)
+filter-spkg () {
+    PKGNAME=$1
+    TAGS_SWITCH=''
+    if [ "$PKGNAME" == sage ]; then
+        TAGS_SWITCH='--tag-name-filter cat'
+    fi
+    git clone -q --bare --shared "$TMPDIR"/spkg-repo "$TMPDIR"/spkg-filter/$PKGNAME &&
+        cd "$TMPDIR"/spkg-filter/$PKGNAME &&
+        $WORKFLOW_DIR/git-filter-branch -f -d "$TMPDIR/filter-branch/$PKGNAME" \
+            --prune-empty --index-filter '' $TAGS_SWITCH $PKGNAME/master \
+            > "$OUTDIR"/spkg-logs/filter-$PKGNAME.log 2>&1
+}
+export -f filter-spkg
+
+# run the function $1 for every line of stdin, $JOBS at a time
+run-pool () {
+    if [[ $(command -v parallel) ]] ; then
+        parallel -j "$JOBS" "$1"
+    else
+        while read ARG ; do
+            while [ $(jobs -rp | wc -l) -ge "$JOBS" ] ; do
+                wait -n
+            done
+            "$1" "$ARG" &
+        done
+        wait
+    fi
+}
+
+mkdir -p "$OUTDIR"/spkg-logs
+spkgs-by-size | run-pool process-spkg-logged
+
+# convert all of them in one go, then strip their whitespace
+git init --bare "$TMPDIR"/spkg-repo
+cat "$TMPDIR"/spkg-git/*/manifest > "$TMPDIR"/spkg-manifest
+pushd "$TMPDIR"/spkg-repo > /dev/null
+$WORKFLOW_DIR/fast-export/hg-fast-export-many.sh "$TMPDIR"/spkg-manifest \
+    -M master --prune-empty > "$OUTDIR"/spkg-logs/hg-fast-export.log 2>&1 ||
+    echo "Converting some of the SPKGs failed, see $OUTDIR/spkg-logs/hg-fast-export.log"
+PKGNAMES=$(git for-each-ref --format='%(refname)' 'refs/heads/*/master' |
+    sed -e 's+^refs/heads/++' -e 's+/master$++')
+popd > /dev/null
+rm -rf "$TMPDIR"/spkg
+for PKGNAME in $PKGNAMES ; do
+    echo $PKGNAME
+done | run-pool filter-spkg
+
+# pull them into the consolidated repo, with the tags of sage, which
+# were converted below refs/tags/sage/
+for PKGNAME in $PKGNAMES ; do
+    TAGS_REFSPEC=''
+    if [ "$PKGNAME" == sage ]; then
+        TAGS_REFSPEC='refs/tags/sage/*:refs/tags/*'
+    fi
+    git fetch -n "$TMPDIR"/spkg-filter/$PKGNAME \
+        $PKGNAME/master:$(cat "$TMPDIR"/spkg-git/$PKGNAME/branch.txt) \
+        ${TAGS_REFSPEC:+"$TAGS_REFSPEC"} &&
+        rm -rf "$TMPDIR"/spkg-filter/$PKGNAME
 done
+rm -rf "$TMPDIR"/spkg-repo
 
 if [[ $(command -v notify-send) ]] ; then
     notify-send "$CMD: finished parsing SPKGs"
 fi
 
 # Humongous octomerge
-# Put together a directory listing for the repo to commit in the merge
+# Collect the directories of the various branches to put together the
+# tree to commit in the merge, as PATH=TREEISH arguments to
+# merge-trees.py
 BRANCHES=$(git branch | sed 's+^\**\s*++')
-DEVOBJS=""
-PKGOBJS=""
-# Collect directory entries from the various branches
+TREES=""
 for BRANCH in $BRANCHES ; do
     case "$BRANCH" in
         base)
-            # Skip for now, we will merge this with the other
-            # trees later
+            # the root of the tree
+            TREES="$TREES $BRANCH"
             ;;
         devel/*)
-            # We incrementally build a list of stuff in $SAGE_SRC/ ;
-            # this $BRANCH will give us one of the subdirs' tree
-            # objects. This will happen twice, once for devel/bin
-            # and once for devel/ext.
+            # $BRANCH will give us one or two subdirs of $SAGE_SRC/
             case "$BRANCH" in
                 devel/ext) BRANCH_DIR="$SAGE_EXTDIR $SAGE_MACAPP" ;;
                 devel/bin) BRANCH_DIR=$SAGE_SCRIPTS_DIR ;;
             esac
-            DEV_ENTRY=$(git ls-tree -d $BRANCH $BRANCH_DIR)
-            DEV_ENTRY=$(sed "s+$SAGE_SRC/++" <<<"$DEV_ENTRY")
-            DEVOBJS="${DEVOBJS}${DEV_ENTRY}\n"
+            for DIR in $BRANCH_DIR ; do
+                TREES="$TREES $DIR=$BRANCH:$DIR"
+            done
             ;;
         library)
-            # We incrementally build a list of stuff in $SAGE_SRC/ ;
-            # this $BRANCH will give us the rest of the entries in
-            # $SAGE_SRC/ .
-            DEV_ENTRIES=$(git ls-tree $BRANCH $SAGE_SRC/)
-            DEV_ENTRIES=$(sed "s+$SAGE_SRC/++" <<<"$DEV_ENTRIES")
-            DEVOBJS="${DEVOBJS}${DEV_ENTRIES}\n"
+            # $BRANCH will give us the rest of the entries in
+            # $SAGE_SRC/
+            TREES="$TREES $SAGE_SRC=$BRANCH:$SAGE_SRC"
             ;;
         packages/*)
-            # We incrementally build a list of stuff in $SAGE_PKGS/
-            # ; this $BRANCH will give us one of the subdirs' tree
-            # objects. This will happen many many times.
+            # $BRANCH will give us one of the subdirs of $SAGE_PKGS/ .
+            # This will happen many many times.
             BRANCH_DIR=$SAGE_PKGS${BRANCH#packages}
-            PKG_ENTRY=$(git ls-tree -d $BRANCH $BRANCH_DIR)
-            PKG_ENTRY=$(sed "s+$SAGE_PKGS/++" <<<"$PKG_ENTRY")
-            PKGOBJS="${PKGOBJS}${PKG_ENTRY}\n"
+            TREES="$TREES $BRANCH_DIR=$BRANCH:$BRANCH_DIR"
             ;;
         *)
             # WTF?
@@ -221,61 +316,10 @@ for BRANCH in $BRANCHES ; do
     esac
 done
 
-# Produce new directory listing objects for $SAGE_PKGS/ and $SAGE_SRC/
-# from the information gathered above, then dump those objects
-# into the listing of the root directory which we are building on
-# stdout. --batch is used because there's an extra newline at the
-# end of $DEVOBJS and $PKGOBJS.
-flatten-tree () {
-    TREE="$1"
-    TREE_DIR="$2"
-    while true
-    do
-        TREE=$(echo -e "040000 tree $TREE\t${TREE_DIR##*/}" | git mktree --missing)
-        if [[ "${TREE_DIR}" != *"/"* ]]; then
-            echo -n "$TREE"
-            return 0
-        fi
-        TREE_DIR="${TREE_DIR%/*}"
-    done
-}
-export -f flatten-tree
-
-get-object () {
-    git ls-tree $1 $2 | cut -f3 -d' ' | cut -f1
-}
-export -f get-object
-
-merge-tree () {
-    local TREE_ONE=$1
-    local TREE_TWO=$2
-    local LS_ONE LS_TWO LS_NEW ITEM
-    LS_ONE="$(git ls-tree --name-only $TREE_ONE)"
-    LS_TWO="$(git ls-tree --name-only $TREE_TWO)"
-    LS_NEW="$(printf '%s\n%s\n' "$LS_ONE" "$LS_TWO"| sort -u)"
-
-    # all duplicates are assumed to be trees
-    for ITEM in $LS_NEW; do
-        if echo "$LS_ONE" | egrep "^$ITEM$" >/dev/null; then
-            if echo "$LS_TWO" | egrep "^$ITEM$" >/dev/null; then
-                echo -e "040000 tree $(merge-tree $(get-object $TREE_ONE "$ITEM") $(get-object $TREE_TWO "$ITEM"))\t$ITEM"
-            else
-                git ls-tree $TREE_ONE "$ITEM"
-            fi
-        else
-            git ls-tree $TREE_TWO "$ITEM"
-        fi
-    done | git mktree --missing
-}
-export -f merge-tree
-
-DEVTREE=$(echo -e "$DEVOBJS" | git mktree --missing --batch)
-PKGTREE=$(echo -e "$PKGOBJS" | git mktree --missing --batch)
-DEVTREE=$(flatten-tree $DEVTREE "$SAGE_SRC")
-PKGTREE=$(flatten-tree $PKGTREE "$SAGE_PKGS")
-
-MERGETREE=$(merge-tree base $DEVTREE)
-MERGETREE=$(merge-tree $MERGETREE $PKGTREE)
+# Merge all of them in one go: the trees are read through a single
+# git cat-file and the merged ones written through a single git mktree
+MERGETREE=$($WORKFLOW_DIR/merge-trees.py --missing $TREES) ||
+    die "Merging the trees of the branches failed"
 
 # Commit the new fully consolidated file tree
 MERGECOMMIT=$(
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Benchmark of the converters on synthetic repositories.
+
+Builds a Mercurial and a Subversion repository of the requested shape
+(both reproducible from the seed and cached in the work directory),
+converts them with hg-fast-export.sh and svn-fast-export.py into fresh
+git repositories via git-fast-import, runs hg-reset.sh on the result
+and writes the timings, including the per-phase breakdown from
+--stats, as JSON. Nothing is fetched from the network."""
+
+from optparse import OptionParser
+from hashlib import sha1
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+# default shape of the generated repositories
+shape_defaults={
+  'revisions':500,    # number of revisions
+  'files':200,        # files in the first revision
+  'changes':5,        # files touched by a revision
+  'size':4096,        # mean size of a text file (log-normally distributed)
+  'merges':0.05,      # chance a revision merges another branch
+  'branches':4,       # named branches besides default
+  'tags':0.02,        # chance a revision gets tagged
+  'binaries':0.01,    # chance a touched file becomes a binary file
+  'binary_size':1<<20,# size of a binary file
+  'seed':1,
+}
+
+root=os.path.dirname(os.path.abspath(__file__))
+
+class Content(object):
+  """Reproducible file contents"""
+
+  def __init__(self,rnd,shape):
+    self.rnd=rnd
+    self.shape=shape
+
+  def text_size(self):
+    mu=math.log(max(self.shape['size'],1))-0.5
+    return min(int(self.rnd.lognormvariate(mu,1.0)),64*self.shape['size'])
+
+  def lines(self,n):
+    return ['%x' % self.rnd.getrandbits(160) for i in range(n)]
+
+  def text(self):
+    return '\n'.join(self.lines(self.text_size()//41+1))+'\n'
+
+  def binary(self):
+    n=self.shape['binary_size']
+    return ('%0*x' % (2*n,self.rnd.getrandbits(8*n))).decode('hex')
+
+  def modify(self,data):
+    """Change a few lines of a text file, replace a binary one"""
+    if '\0' in data:
+      return self.binary()
+    l=data.split('\n')
+    for i in range(self.rnd.randint(1,3)):
+      l[self.rnd.randrange(len(l))]=self.lines(1)[0]
+    l[-1:]=self.lines(self.rnd.randint(0,2))+['']
+    return '\n'.join(l)
+
+def history(shape):
+  """Yield the synthetic history as (branch,parent,merge,files,changes)
+  where parent and merge are indices of earlier revisions or None,
+  files is the resulting {path:(data,flags)} and changes the paths set
+  or removed relative to parent"""
+  rnd=random.Random(shape['seed'])
+  content=Content(rnd,shape)
+  # branch -> (revision,files) of its head
+  heads={}
+  files={}
+  for i in range(shape['files']):
+    files['dir%d/file%d.txt' % (i%16,i)]=(content.text(),'')
+  heads['default']=(0,files)
+  yield 'default',None,None,files,files.keys()
+  rev=1
+  serial=shape['files']
+  while rev<shape['revisions']:
+    branch=rnd.choice(['default']+['branch%d' % i for i in range(shape['branches'])])
+    if branch not in heads:
+      # fork from default
+      parent,files=heads['default']
+    else:
+      parent,files=heads[branch]
+    others=[b for b in heads if b!=branch]
+    files=dict(files)
+    merge=None
+    if branch in heads and others and rnd.random()<shape['merges']:
+      merge,theirs=heads[rnd.choice(others)]
+      changes=[f for f in theirs if files.get(f)!=theirs[f]]
+      for f in changes:
+        files[f]=theirs[f]
+    else:
+      changes=[]
+      # .hgtags is only written by tagging
+      paths=sorted([f for f in files if f!='.hgtags'])
+      for i in range(shape['changes']):
+        op=rnd.random()
+        if op<0.15 or not paths:
+          serial+=1
+          f='dir%d/file%d.txt' % (serial%16,serial)
+          files[f]=(content.text(),'')
+          paths.append(f)
+        elif op<0.25:
+          f=paths.pop(rnd.randrange(len(paths)))
+          del files[f]
+        elif op<0.3:
+          f=rnd.choice(paths)
+          data,flags=files[f]
+          files[f]=(data,flags and '' or 'x')
+        else:
+          f=rnd.choice(paths)
+          data,flags=files[f]
+          if rnd.random()<shape['binaries']:
+            data=content.binary()
+          else:
+            data=content.modify(data)
+          files[f]=(data,flags)
+        changes.append(f)
+    heads[branch]=(rev,files)
+    yield branch,parent,merge,files,changes
+    rev+=1
+    if rev<shape['revisions'] and rnd.random()<shape['tags']:
+      # tag as 'hg tag' does it, in a revision of its own
+      tags=files.get('.hgtags',('',''))[0]
+      files=dict(files)
+      files['.hgtags']=(tags+'%d tag%d\n' % (rev-1,rev-1),'')
+      heads[branch]=(rev,files)
+      yield branch,rev-1,None,files,['.hgtags']
+      rev+=1
+
+def make_hg(path,shape):
+  from mercurial import context,hg,node,ui
+
+  myui=ui.ui()
+  myui.setconfig('ui','quiet','true')
+  repo=hg.repository(myui,path,create=True)
+  nodes=[]
+  for branch,parent,merge,files,changes in history(shape):
+    def filectx(repo,ctx,f):
+      if f not in files:
+        raise IOError()
+      data,flags=files[f]
+      if f=='.hgtags':
+        # tag the revision by node, not by number
+        data=''.join(['%s %s\n' % (node.hex(nodes[int(r)]),t)
+            for r,t in [l.split(' ') for l in data.splitlines()]])
+      return context.memfilectx(f,data,False,'x' in flags,None)
+    parents=[parent,merge]
+    parents=[p!=None and nodes[p] or node.nullid for p in parents]
+    extra={}
+    if branch!='default':
+      extra['branch']=branch
+    ctx=context.memctx(repo,parents,'revision %d' % len(nodes),sorted(changes),
+        filectx,'Bench User <bench@example.com>','%d 0' % (1000000000+len(nodes)*60),extra)
+    nodes.append(repo.commitctx(ctx))
+
+def svn_props(props):
+  s=''.join(['K %d\n%s\nV %d\n%s\n' % (len(k),k,len(v),v) for k,v in props])
+  return s+'PROPS-END\n'
+
+def make_svn(path,shape):
+  """Load the default branch of the history into trunk of a new
+  Subversion repository with svnadmin; the other branches and the tags
+  are left out, so only the export of trunk is timed"""
+  subprocess.check_call(['svnadmin','create',path])
+  dump=open(path+'.dump','wb')
+  dump.write('SVN-fs-dump-format-version: 2\n\n')
+  dirs=set()
+  old={}
+  rev=0
+  for branch,parent,merge,files,changes in history(shape):
+    if branch!='default':
+      continue
+    # relative to the last default revision, merges included
+    changes=[f for f in files if old.get(f)!=files[f][0]]+[f for f in old if f not in files]
+    rev+=1
+    props=svn_props([('svn:author','bench'),
+        ('svn:date',time.strftime('%Y-%m-%dT%H:%M:%S.000000Z',time.gmtime(1000000000+rev*60))),
+        ('svn:log','revision %d' % rev)])
+    dump.write('Revision-number: %d\nProp-content-length: %d\nContent-length: %d\n\n%s\n' %
+        (rev,len(props),len(props),props))
+    for f in sorted(changes):
+      p='trunk/'+f
+      d=p.rsplit('/',1)[0]
+      parts=d.split('/')
+      for i in range(len(parts)):
+        d='/'.join(parts[:i+1])
+        if d not in dirs:
+          dirs.add(d)
+          dump.write('Node-path: %s\nNode-kind: dir\nNode-action: add\n\n' % d)
+      if f not in files:
+        dump.write('Node-path: %s\nNode-action: delete\n\n' % p)
+        del old[f]
+        continue
+      data=files[f][0]
+      action=f in old and 'change' or 'add'
+      dump.write('Node-path: %s\nNode-kind: file\nNode-action: %s\n'
+          'Text-content-length: %d\nContent-length: %d\n\n%s\n\n' % (p,action,len(data),len(data),data))
+      old[f]=data
+  dump.close()
+  f=open(path+'.dump','rb')
+  subprocess.check_call(['svnadmin','load','--quiet',path],stdin=f)
+  f.close()
+  os.unlink(path+'.dump')
+
+def shape_key(kind,shape):
+  return '%s-%s' % (kind,sha1(json.dumps(shape,sort_keys=True)).hexdigest()[:12])
+
+def which(program):
+  for d in os.environ.get('PATH','').split(os.pathsep):
+    if os.access(os.path.join(d,program),os.X_OK):
+      return True
+  return False
+
+def last_stats(filename):
+  r=None
+  if os.path.exists(filename):
+    for line in open(filename):
+      r=json.loads(line)
+  return r
+
+def run(cmd,cwd,env=None,shell=False):
+  """Run cmd with its output appended to bench.log in the work
+  directory, return its wall and CPU time"""
+  log=open(os.path.join(os.path.dirname(cwd),'bench.log'),'a')
+  devnull=open(os.devnull,'w')
+  t=os.times()
+  start=time.time()
+  p=subprocess.Popen(cmd,cwd=cwd,env=env,stdout=devnull,stderr=log,shell=shell)
+  ret=p.wait()
+  wall=time.time()-start
+  u=os.times()
+  devnull.close()
+  log.close()
+  if ret!=0:
+    raise RuntimeError('%s failed with exit status %d, see %s' % (cmd,ret,log.name))
+  return wall,(u[2]+u[3])-(t[2]+t[3])
+
+def git_init(path):
+  if os.path.exists(path):
+    shutil.rmtree(path)
+  subprocess.check_call(['git','init','-q',path])
+
+def bench_hg(work,hgrepo,revisions,python,args):
+  """Time a full and an incremental hg-fast-export.sh and hg-reset.sh"""
+  results={}
+  env=dict(os.environ,PYTHON=python)
+  gitdir=os.path.join(work,'git-hg')
+  stats=os.path.join(work,'hg.stats')
+
+  def export(name,extra):
+    if os.path.exists(stats):
+      os.unlink(stats)
+    wall,cpu=run([os.path.join(root,'hg-fast-export.sh'),'--quiet','-r',hgrepo,'--force',
+        '--stats',stats]+args+extra,gitdir,env)
+    results[name]={'wall':wall,'cpu':cpu,'stats':last_stats(stats)}
+
+  git_init(gitdir)
+  export('hg-fast-export',[])
+  git_init(gitdir)
+  export('hg-fast-export-first-half',['-m',str(revisions//2)])
+  export('hg-fast-export-incremental',[])
+  del results['hg-fast-export-first-half']
+
+  wall,cpu=run([os.path.join(root,'hg-reset.sh'),'-R',str(revisions//2)],gitdir,env)
+  results['hg-reset']={'wall':wall,'cpu':cpu}
+  return results
+
+def bench_svn(work,svnrepo,python,args):
+  gitdir=os.path.join(work,'git-svn')
+  stats=os.path.join(work,'svn.stats')
+  if os.path.exists(stats):
+    os.unlink(stats)
+  git_init(gitdir)
+  cmd='"%s" "%s" --stats "%s" %s "%s" | git fast-import --quiet' % (python,
+      os.path.join(root,'svn-fast-export.py'),stats,' '.join(args),svnrepo)
+  wall,cpu=run(cmd,gitdir,shell=True)
+  return {'svn-fast-export':{'wall':wall,'cpu':cpu,'stats':last_stats(stats)}}
+
+def summarize(runs):
+  """Merge the results of several runs: minimum and median wall time,
+  the rest from the fastest run"""
+  merged={}
+  for tool in runs[0]:
+    l=sorted([r[tool] for r in runs],key=lambda r: r['wall'])
+    m=dict(l[0])
+    m['median_wall']=l[len(l)//2]['wall']
+    m['runs']=len(l)
+    merged[tool]=m
+  return merged
+
+def compare(old,new,tolerance):
+  """Print old and new wall times, return the number of regressions"""
+  bad=0
+  if old.get('shape')!=new.get('shape'):
+    sys.stderr.write('Warning: baseline was taken with a different shape\n')
+  for tool in sorted(new['results']):
+    o=old['results'].get(tool)
+    n=new['results'][tool]
+    if o==None or 'wall' not in o or 'wall' not in n:
+      continue
+    n=n['wall']
+    ratio=n/max(o['wall'],1e-6)
+    flag=''
+    if ratio>1+tolerance:
+      flag=' REGRESSION'
+      bad+=1
+    sys.stdout.write('%-28s %8.3fs %8.3fs %6.2fx%s\n' % (tool,o['wall'],n,ratio,flag))
+  return bad
+
+if __name__=='__main__':
+  parser=OptionParser(usage='%prog [options]')
+
+  for k,v in sorted(shape_defaults.items()):
+    parser.add_option('--'+k.replace('_','-'),type=type(v)==float and 'float' or 'int',
+        dest=k,default=v,help='Repository shape: %s (default %s)' % (k,v))
+  parser.add_option('-w','--workdir',dest='workdir',default='bench-work',
+      help='Directory to keep generated repositories and results in')
+  parser.add_option('-n','--runs',type='int',dest='runs',default=3,
+      help='Number of timed runs of each converter')
+  parser.add_option('-o','--output',dest='output',
+      help='Write results as JSON to OUTPUT')
+  parser.add_option('-c','--compare',dest='baseline',
+      help='Compare against the results in BASELINE')
+  parser.add_option('-t','--tolerance',type='float',dest='tolerance',default=0.1,
+      help='Slowdown reported as regression (default 0.1, i.e. 10%)')
+  parser.add_option('--only',dest='only',
+      help='Only run the hg or the svn benchmarks')
+  parser.add_option('-a','--args',dest='args',default='',
+      help='Extra arguments passed to hg-fast-export.sh')
+  parser.add_option('--svn-args',dest='svn_args',default='',
+      help='Extra arguments passed to svn-fast-export.py')
+
+  (options,args)=parser.parse_args()
+
+  shape=dict([(k,getattr(options,k)) for k in shape_defaults])
+  work=os.path.abspath(options.workdir)
+  if not os.path.isdir(work):
+    os.makedirs(work)
+  python=os.environ.get('PYTHON',sys.executable)
+  extra=options.args.split()
+  svn_extra=options.svn_args.split()
+
+  results={}
+  if options.only in (None,'hg'):
+    hgrepo=os.path.join(work,shape_key('hg',shape))
+    if not os.path.isdir(hgrepo):
+      sys.stderr.write('Generating %s\n' % hgrepo)
+      try:
+        make_hg(hgrepo,shape)
+      except:
+        shutil.rmtree(hgrepo,True)
+        raise
+    results.update(summarize([bench_hg(work,hgrepo,shape['revisions'],python,extra) for i in range(options.runs)]))
+
+  if options.only in (None,'svn'):
+    svnrepo=os.path.join(work,shape_key('svn',shape))
+    if not which('svnadmin'):
+      results['svn-fast-export']={'skipped':'svnadmin not found'}
+    elif subprocess.call([python,'-c','import svn.fs'])!=0:
+      results['svn-fast-export']={'skipped':'no Subversion Python bindings'}
+    else:
+      if not os.path.isdir(svnrepo):
+        sys.stderr.write('Generating %s\n' % svnrepo)
+        try:
+          make_svn(svnrepo,shape)
+        except:
+          shutil.rmtree(svnrepo,True)
+          raise
+      results.update(summarize([bench_svn(work,svnrepo,python,svn_extra) for i in range(options.runs)]))
+
+  report={'time':time.time(),'shape':shape,'python':python,'args':extra,'svn_args':svn_extra,'results':results}
+
+  for tool in sorted(results):
+    r=results[tool]
+    if r.get('skipped'):
+      sys.stderr.write('%-28s skipped: %s\n' % (tool,r['skipped']))
+    else:
+      sys.stderr.write('%-28s %8.3fs wall %8.3fs cpu\n' % (tool,r['wall'],r['cpu']))
+
+  if options.output!=None:
+    f=open(options.output,'w')
+    json.dump(report,f,indent=1,sort_keys=True)
+    f.write('\n')
+    f.close()
+
+  if options.baseline!=None:
+    if compare(json.load(open(options.baseline)),report,options.tolerance)>0:
+      sys.exit(1)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+from telemetry import null_phase
+import sys
+
+# flush the stream buffer to git-fast-import once it holds this many bytes
+cfg_buffer_size=1<<20
+
+try:
+  # Python 2: file.write() only takes the old-style buffer protocol
+  _view=buffer
+except NameError:
+  def _view(b,offset,size):
+    return memoryview(b)[offset:offset+size]
+
+def tobytes(s):
+  """Return s as a byte string, encoding unicode as UTF-8"""
+  if isinstance(s,(bytes,bytearray)):
+    return s
+  return s.encode('utf-8')
+
+class StreamWriter(object):
+  """Buffered writer for a git-fast-import stream.
+
+  Headers and small payloads are copied into one preallocated buffer
+  which is handed to the output file whenever it fills up; payloads
+  larger than the buffer are written straight through."""
+
+  def __init__(self,out=None,size=None):
+    if out==None:
+      out=sys.stdout
+    # Python 3's sys.stdout is a text stream, write to its binary layer
+    self.out=getattr(out,'buffer',out)
+    self.size=size or cfg_buffer_size
+    self.buf=bytearray(self.size)
+    self.pos=0
+    self.bytes=0
+    self.commands=0
+    # telemetry.Telemetry accounting the time blocked on the output
+    self.stats=None
+
+  def emit(self,b):
+    with self.phase():
+      self.out.write(b)
+
+  def phase(self):
+    if self.stats==None:
+      return null_phase
+    return self.stats.phase('write')
+
+  def write(self,b):
+    b=tobytes(b)
+    n=len(b)
+    self.bytes+=n
+    if self.pos+n>self.size:
+      self.flush()
+      if n>=self.size:
+        self.emit(b)
+        return
+    self.buf[self.pos:self.pos+n]=b
+    self.pos+=n
+
+  def line(self,msg=''):
+    if msg:
+      self.write(msg)
+    self.write(b'\n')
+
+  def command(self,msg):
+    """Write a top-level command like 'commit', 'blob' or 'reset'"""
+    self.commands+=1
+    self.line(msg)
+
+  def data(self,*parts):
+    """Write a 'data' command whose payload is the concatenation of
+    parts, without building the concatenation"""
+    parts=[tobytes(p) for p in parts]
+    self.line('data %d' % sum([len(p) for p in parts]))
+    for p in parts:
+      self.write(p)
+    self.write(b'\n')
+
+  def stream(self,size,pieces):
+    """Write a 'data' command of size bytes whose payload is handed
+    over in pieces, never held as a whole"""
+    self.line('data %d' % size)
+    n=0
+    for p in pieces:
+      n+=len(p)
+      self.write(p)
+    if n!=size:
+      raise ValueError('data of %d bytes announced as %d bytes' % (n,size))
+    self.write(b'\n')
+
+  def flush(self):
+    if self.pos:
+      self.emit(_view(self.buf,0,self.pos))
+      self.pos=0
+    with self.phase():
+      self.out.flush()
@@ -0,0 +1,123 @@
+#!/bin/sh
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+ROOT="`dirname $0`"
+MANIFEST=""
+PFX="hg2git-many"
+GFI_OPTS=""
+PY_OPTS=""
+PYTHON=${PYTHON:-python}
+
+USAGE="[--quiet] [--force] <manifest> [hg-fast-export.py options]"
+LONG_USAGE="Import all hg repositories listed in <manifest> with one
+hg-fast-export.py and one git-fast-import(1) process.
+Every line of <manifest> names a repository, the prefix of the files
+to keep its state in (<prefix>-marks, <prefix>-state etc., relative to
+the top of the git repository) and optionally hg-fast-export.py options
+for it only, like -M, or -o to put its branches and tags below a
+name of their own.
+Empty lines and lines starting with # are skipped. Options after
+<manifest> apply to all repositories.
+
+Options:
+	--quiet	Passed to git-fast-import(1)
+	--force Ignore validation errors when converting, and pass --force
+		to git-fast-import(1)
+"
+
+. "$(git --exec-path)/git-sh-setup"
+cd_to_toplevel
+
+while case "$#" in 0) break ;; esac
+do
+  case "$1" in
+    --q|--qu|--qui|--quie|--quiet)
+      GFI_OPTS="$GFI_OPTS --quiet"
+      ;;
+    --force)
+      GFI_OPTS="$GFI_OPTS --force"
+      PY_OPTS="$PY_OPTS --force"
+      ;;
+    -*)
+      usage
+      ;;
+    *)
+      MANIFEST="$1"
+      shift
+      break
+      ;;
+  esac
+  shift
+done
+
+if [ x"$MANIFEST" = x -o ! -f "$MANIFEST" ] ; then
+  usage
+fi
+
+# the state file prefix and the branch namespace (-o, - if none) of
+# every repository
+REPOS="`sed -e '/^[[:space:]]*#/d' -e '/^[[:space:]]*$/d' "$MANIFEST" | awk '{
+  o = "-"
+  for (i = 3; i <= NF; i++) {
+    if (($i == "-o" || $i == "--origin") && i < NF) o = $(i+1)
+    else if ($i ~ /^--origin=/) o = substr($i, 10)
+    else if ($i ~ /^-o./) o = substr($i, 3)
+  }
+  print $2, o
+}'`"
+ORIGINS="`echo "$REPOS" | awk '$2 != "-" { print $2 }'`"
+
+# print the heads of the repository with branch namespace $1 for its
+# heads cache: those below $1, or those below no namespace if it has none
+heads_of () {
+  if [ "$1" != - ] ; then
+    git for-each-ref --format=':%(refname) %(objectname)' "refs/heads/$1"
+  elif [ x"$ORIGINS" = x ] ; then
+    git for-each-ref --format=':%(refname) %(objectname)' refs/heads
+  else
+    git for-each-ref --format=':%(refname) %(objectname)' refs/heads \
+    | grep -v -F "`echo "$ORIGINS" | sed 's#^.*$#:refs/heads/&/#'`"
+  fi | sed 's#^:refs/heads/#:#'
+}
+
+# make room for the state files and the marks caches
+while read PREFIX ORIGIN ; do
+  mkdir -p "`dirname "$PREFIX"`" || exit 1
+  if [ ! -f "$PREFIX-marks" ] ; then
+    touch "$PREFIX-marks"
+  fi
+done <<EOF
+$REPOS
+EOF
+
+# cleanup on exit
+trap 'rm -f "$GIT_DIR/$PFX-marks" "$GIT_DIR/$PFX-exit"' 0
+
+# the exit status of the exporter, sh has no pipefail
+echo 1 > "$GIT_DIR/$PFX-exit"
+{
+  GIT_DIR="$GIT_DIR" $PYTHON "$ROOT/hg-fast-export.py" \
+    --manifest "$MANIFEST" $PY_OPTS "$@"
+  echo $? > "$GIT_DIR/$PFX-exit"
+} | git fast-import $GFI_OPTS --export-marks="$GIT_DIR/$PFX-marks"
+GFI_EXIT=$?
+EXPORT_EXIT="`cat "$GIT_DIR/$PFX-exit"`"
+
+# give every repository its marks, even after a failure: the k-th
+# repository (from 0) has the marks from k<<32 on, and only its own
+# heads go into its heads cache, lest hg-reset.py take the others for
+# stale branches
+K=0
+while read PREFIX ORIGIN ; do
+  $PYTHON "$ROOT/revstore.py" import-marks \
+    "$PREFIX-marks" "$GIT_DIR/$PFX-marks" $((K<<32)) || exit 1
+  heads_of "$ORIGIN" > "$PREFIX-heads"
+  K=$((K+1))
+done <<EOF
+$REPOS
+EOF
+
+if [ "$GFI_EXIT" != 0 -o "$EXPORT_EXIT" != 0 ] ; then
+  exit 1
+fi
@@ -3,13 +3,29 @@
 # Copyright (c) 2007, 2008 Rocco Rutte <pdmef@gmx.net> and others.
 # License: MIT <http://www.opensource.org/licenses/mit-license.php>
 
-from mercurial import node
-from hg2git import setup_repo,fixup_user,get_branch,get_changeset
-from hg2git import load_cache,save_cache,get_git_sha1,set_default_branch,set_origin_name
+from mercurial import node,mdiff
+from hg2git import setup_repo,fixup_user,get_branch,get_tag,get_changeset,sanitize_name
+from hg2git import AuthorMap,load_authors,no_paths,load_path_rules
+from hg2git import load_cache,save_cache,get_git_sha1,reset_git_refs,set_default_branch,set_origin_name
+from hg2git import set_tag_namespace
+from hg2git import FileStream,file_size,file_stream
+from revstore import replace
+from gfi import StreamWriter
+from telemetry import Telemetry
+from revstore import Marks,BlobKeys,open_mapping
 from optparse import OptionParser
+from hashlib import sha1,sha256
+from collections import deque,OrderedDict
+from multiprocessing import Pool
+import subprocess
+import shlex
+import copy
 import re
 import sys
 import os
+import struct
+import signal
+import time
 
 if sys.platform == "win32":
   # On Windows, sys.stdout is initially opened in text mode, which means that
@@ -19,68 +35,200 @@ if sys.platform == "win32":
   import msvcrt
   msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
 
+# the git-fast-import stream we produce
+out=StreamWriter(sys.stdout)
+# time spent per phase, written with --stats
+stats=Telemetry()
+out.stats=stats
+
 # silly regex to catch Signed-off-by lines in log message
 sob_re=re.compile('^Signed-[Oo]ff-[Bb]y: (.+)$')
 # insert 'checkpoint' command after this many commits or none at all if 0
 cfg_checkpoint_count=0
+# also insert one after this many bytes of stream or never if 0
+cfg_checkpoint_bytes=0
 # write some progress message every this many file contents written
 cfg_export_boundary=1000
+# also deduplicate blobs by content, not only by filelog node
+cfg_hash_blobs=False
+# number of worker processes reading revisions ahead, 0 to read serially
+cfg_prefetch_workers=0
+# number of revisions the workers may read ahead
+cfg_prefetch_window=64
+# bytes of file data held by read-ahead revisions at most
+cfg_prefetch_bytes=256<<20
+# number of git-fast-import processes blobs are sent to ahead of the
+# commits, 0 to send them along with the commits
+cfg_blob_shards=0
+# stream file revisions larger than this many bytes from the revlog
+# instead of reading them into memory, 0 to never stream
+cfg_stream_size=16<<20
+# directory to move file revisions larger than cfg_side_store_size
+# bytes to, leaving git-lfs pointer files in their place
+cfg_side_store=None
+cfg_side_store_size=100<<20
+# number of manifest texts kept for computing merge deltas
+cfg_manifest_cache=16
+# skip commits without changes left after applying the path rules
+cfg_prune_empty=False
+# rules mapping hg file paths to git paths, see hg2git.PathMap
+paths=no_paths
+# send files copied or renamed unchanged as C and R commands instead of
+# their contents again
+cfg_copies=False
+# also export the repository's tags
+cfg_export_tags=True
+# added to every mark written to the stream. The repositories of a
+# manifest share one stream, the k-th (from 0) uses offset k<<32.
+cfg_mark_offset=0
+# keep running after the export and export new revisions as they come,
+# looking for them every this many seconds; 0 to exit
+cfg_watch=0
+# set by SIGINT or SIGTERM to have a watching exporter stop
+stop_watching=False
+
+# manifest node -> text, least recently used first
+manifest_cache=OrderedDict()
 
 def gitmode(flags):
   return 'l' in flags and '120000' or 'x' in flags and '100755' or '100644'
 
-def wr(msg=''):
-  if msg:
-    sys.stdout.write(msg)
-  sys.stdout.write('\n')
-  #map(lambda x: sys.stderr.write('\t[%s]\n' % x),msg.split('\n'))
+# stream offset of the last checkpoint
+checkpoint_bytes=0
 
-def checkpoint(count):
+def checkpoint(count,persist=None,tip=None):
+  """Count a commit and issue a checkpoint if one is due. git-fast-import
+  then writes out its pack, refs and marks, and persist(tip) saves our
+  state of the revisions before tip to match"""
+  global checkpoint_bytes
   count=count+1
-  if cfg_checkpoint_count>0 and count%cfg_checkpoint_count==0:
+  if ((cfg_checkpoint_count>0 and count%cfg_checkpoint_count==0) or
+      (cfg_checkpoint_bytes>0 and out.bytes-checkpoint_bytes>=cfg_checkpoint_bytes)):
     sys.stderr.write("Checkpoint after %d commits\n" % count)
-    wr('checkpoint')
-    wr()
+    out.command('checkpoint')
+    out.line()
+    out.flush()
+    checkpoint_bytes=out.bytes
+    if persist!=None:
+      persist(tip)
   return count
 
+def markref(mark):
+  """Convert one of our marks to the mark in the stream"""
+  return ':%d' % (mark+cfg_mark_offset)
+
 def revnum_to_revref(rev, old_marks):
   """Convert an hg revnum to a git-fast-import rev reference (an SHA1
-  or a mark)"""
-  return old_marks.get(rev) or ':%d' % (rev+1)
-
-def file_mismatch(f1,f2):
-  """See if two revisions of a file are not equal."""
-  return node.hex(f1)!=node.hex(f2)
-
-def split_dict(dleft,dright,l=[],c=[],r=[],match=file_mismatch):
-  """Loop over our repository and find all changed and missing files."""
-  for left in dleft.keys():
+  or a mark) of its commit or, if it was pruned, of the one standing
+  for it. None if there is none."""
+  mark=old_marks.resolve(rev+1)
+  if mark==0:
+    return None
+  return old_marks.get(mark) or markref(mark)
+
+def blobref(mark,old_marks):
+  """Convert a blob mark to a git-fast-import data reference (an SHA1
+  if an earlier run exported it, the mark otherwise)"""
+  return old_marks.get(mark) or markref(mark)
+
+def load_blobs(filename,old_marks):
+  """Load the blob table of an earlier run, dropping entries whose marks
+  git-fast-import never exported (i.e. that run failed)"""
+  blobs=BlobKeys(filename)
+  blobs.drop(lambda mark: old_marks.get(mark)!=None)
+  return blobs
+
+def next_blob_mark(blobs,old_marks):
+  """Return the first blob mark not used by any earlier run"""
+  return max(old_marks.next_blob(),getattr(blobs,'end',0))
+
+def manifest_text(repo,mnode):
+  """Return the text of a manifest, keeping the most recently used ones
+  around: consecutive merges tend to share their parents"""
+  text=manifest_cache.pop(mnode,None)
+  if text==None:
+    text=repo.manifest.revision(mnode)
+  manifest_cache[mnode]=text
+  if len(manifest_cache)>cfg_manifest_cache:
+    manifest_cache.popitem(last=False)
+  return text
+
+def parse_manifest(text,entries=None):
+  """Parse manifest lines into a dict mapping each file to its hex
+  filenode followed by its flags"""
+  if entries==None:
+    entries={}
+  for line in text.splitlines():
+    f,v=line.split('\0',1)
+    entries[f]=v
+  return entries
+
+def manifest_delta(repo,mleft,mright):
+  """Return the entries that differ between two manifests as two dicts
+  as built by parse_manifest(). Only the lines touched by the delta
+  between them are parsed: the one stored in the revlog if there is
+  one, a line diff of the texts otherwise."""
+  ml=repo.manifest
+  rtext=manifest_text(repo,mright)
+  lrev,rrev=ml.rev(mleft),ml.rev(mright)
+  # older Mercurial has no deltaparent()
+  if hasattr(ml,'deltaparent') and hasattr(ml,'revdiff') and ml.deltaparent(lrev)==rrev:
+    delta=ml.revdiff(rrev,lrev)
+  else:
+    delta=mdiff.textdiff(rtext,manifest_text(repo,mleft))
+  left,right={},{}
+  pos=0
+  while pos<len(delta):
+    start,end,l=struct.unpack('>lll',delta[pos:pos+12])
+    pos+=12
+    data=delta[pos:pos+l]
+    pos+=l
+    if ((start>0 and rtext[start-1]!='\n') or (end>0 and rtext[end-1]!='\n')
+        or (l>0 and data[-1]!='\n')):
+      # not a line based delta: compare the full manifests
+      left=parse_manifest(manifest_text(repo,mleft))
+      right=parse_manifest(rtext)
+      break
+    parse_manifest(rtext[start:end],right)
+    parse_manifest(data,left)
+  for f,v in left.items():
+    if right.get(f)==v:
+      del left[f]
+      del right[f]
+  return left,right
+
+def split_dict(dleft,dright,l,c,r):
+  """Loop over manifest entries and find all changed and missing files."""
+  for left,v in dleft.iteritems():
     right=dright.get(left,None)
     if right==None:
       # we have the file but our parent hasn't: add to left set
-      l.append(left)
-    elif match(dleft[left],right):
-      # we have it but checksums mismatch: add to center set
-      c.append(left)
-  for right in dright.keys():
-    left=dleft.get(right,None)
-    if left==None:
+      l.add(left)
+    elif v!=right:
+      # we have it but nodes or flags mismatch: add to center set
+      c.add(left)
+  for right in dright:
+    if right not in dleft:
       # if parent has file but we don't: add to right set
-      r.append(right)
+      r.add(right)
     # change is already handled when comparing child against parent
   return l,c,r
 
-def get_filechanges(repo,revision,parents,mleft):
-  """Given some repository and revision, find all changed/deleted files."""
-  l,c,r=[],[],[]
+def get_filechanges(repo,revision,parents):
+  """Given some repository and revision, find all changed/deleted files.
+  Also returns the manifest entries of the changed files."""
+  cl=repo.changelog
+  mleft=cl.read(cl.node(revision))[0]
+  l,c,r=set(),set(),set()
+  entries={}
   for p in parents:
     if p<0: continue
-    mright=repo.changectx(p).manifest()
-    l,c,r=split_dict(mleft,mright,l,c,r)
-  l.sort()
-  c.sort()
-  r.sort()
-  return l,c,r
+    dleft,dright=manifest_delta(repo,mleft,cl.read(cl.node(p))[0])
+    split_dict(dleft,dright,l,c,r)
+    entries.update(dleft)
+  # a file added with respect to one parent is exported only once
+  c-=l
+  return sorted(l),sorted(c),sorted(r),entries
 
 def get_author(logmessage,committer,authors):
   """As git distincts between author and committer of a patch, try to
@@ -98,13 +246,17 @@ def get_author(logmessage,committer,authors):
   "Signed-off-by: foo" and thus matching our detection regex. Prevent
   that."""
 
-  loglines=logmessage.split('\n')
-  i=len(loglines)
-  # from tail walk to top skipping empty lines
-  while i>=0:
-    i-=1
-    if len(loglines[i].strip())==0: continue
-    break
+  if 'Signed-' not in logmessage:
+    # sob_re cannot match, spare splitting the message
+    i=-1
+  else:
+    loglines=logmessage.split('\n')
+    i=len(loglines)
+    # from tail walk to top skipping empty lines
+    while i>=0:
+      i-=1
+      if len(loglines[i].strip())==0: continue
+      break
   if i>=0:
     # walk further upwards to find first sob line, store in 'first'
     first=None
@@ -123,156 +275,500 @@ def get_author(logmessage,committer,authors):
       return "Invalid User <invalid@email.com>"
   return committer
 
-def export_file_contents(ctx,manifest,files):
+def read_file(repo,file,fnode):
+  """Return the contents of a file revision, as a FileStream if it is
+  larger than cfg_stream_size and stored as a full text"""
+  with stats.phase('filedata'):
+    if cfg_stream_size>0 and file_size(repo,file,fnode)>cfg_stream_size:
+      s=file_stream(repo,file,fnode)
+      if s!=None:
+        return s
+    return repo.filectx(file,fileid=fnode).data()
+
+def pieces(d):
+  if isinstance(d,FileStream):
+    return d
+  return [d]
+
+def data_size(d):
+  if isinstance(d,FileStream):
+    return d.size
+  return len(d)
+
+def store_file(d):
+  """Move contents to the side store, named by their SHA256 like
+  git-lfs does in .git/lfs/objects, and return the pointer file"""
+  h=sha256()
+  tmp=os.path.join(cfg_side_store,'tmp-%d' % os.getpid())
+  f=open(tmp,'wb')
+  for p in pieces(d):
+    h.update(p)
+    f.write(p)
+  f.close()
+  oid=h.hexdigest()
+  dst=os.path.join(cfg_side_store,oid[0:2],oid[2:4],oid)
+  if os.path.exists(dst):
+    os.unlink(tmp)
+  else:
+    if not os.path.isdir(os.path.dirname(dst)):
+      os.makedirs(os.path.dirname(dst))
+    replace(tmp,dst)
+  return 'version https://git-lfs.github.com/spec/v1\noid sha256:%s\nsize %d\n' % (oid,data_size(d))
+
+def export_file_contents(repo,files,info,old_marks,blobs,counters,shards=None):
+  """Write a blob for every file revision in files not sent before
+  and return the (mode,dataref,path) entries for the commit. The blobs
+  go to the least busy of shards if given, to out otherwise"""
   count=0
+  sent=0
   max=len(files)
+  entries=[]
   for file in files:
     # Skip .hgtags files. They only get us in trouble.
     if file == ".hgtags":
       sys.stderr.write('Skip %s\n' % (file))
       continue
-    d=ctx.filectx(file).data()
-    wr('M %s inline %s' % (gitmode(manifest.flags(file)),file))
-    wr('data %d' % len(d)) # had some trouble with size()
-    wr(d)
+    path=paths.map(file)
+    if path==None:
+      continue
+    fnode,flags,d=info[file]
+    key='f'+fnode
+    mark=blobs.get(key)
+    ckey=None
+    if mark==None and cfg_hash_blobs:
+      # same content under another filelog node (other file, backout...)
+      if d==None:
+        d=read_file(repo,file,fnode)
+      h=sha1()
+      for p in pieces(d):
+        h.update(p)
+      ckey='c'+h.digest()
+      mark=blobs.get(ckey)
+    if mark==None:
+      if d==None:
+        d=read_file(repo,file,fnode)
+      if cfg_side_store!=None and data_size(d)>cfg_side_store_size:
+        d=store_file(d)
+      mark=counters['blob']
+      counters['blob']+=1
+      w=out
+      if shards!=None:
+        w=shards.writer()
+      w.command('blob')
+      w.line('mark %s' % markref(mark))
+      if isinstance(d,FileStream):
+        w.stream(d.size,d)
+      else:
+        w.data(d) # had some trouble with size()
+      sent+=1
+      if ckey!=None:
+        blobs[ckey]=mark
+    blobs[key]=mark
+    entries.append((gitmode(flags),blobref(mark,old_marks),path))
     count+=1
     if count%cfg_export_boundary==0:
-      sys.stderr.write('Exported %d/%d files\n' % (count,max))
+      sys.stderr.write('Exported %d/%d files (%d new blobs)\n' % (count,max,sent))
   if max>cfg_export_boundary:
-    sys.stderr.write('Exported %d/%d files\n' % (count,max))
-
-def sanitize_name(name,what="branch"):
-  """Sanitize input roughly according to git-check-ref-format(1)"""
-
-  def dot(name):
-    if name[0] == '.': return '_'+name[1:]
-    return name
-
-  n=name
-  p=re.compile('([[ ~^:?*]|\.\.)')
-  n=p.sub('_', n)
-  if n[-1] in ('/', '.'): n=n[:-1]+'_'
-  n='/'.join(map(dot,n.split('/')))
-  p=re.compile('_+')
-  n=p.sub('_', n)
-
-  if n!=name:
-    sys.stderr.write('Warning: sanitized %s [%s] to [%s]\n' % (what,name,n))
-  return n
-
-def export_commit(ui,repo,revision,old_marks,max,count,authors,sob,brmap):
-  def get_branchname(name):
-    if brmap.has_key(name):
-      return brmap[name]
-    n=sanitize_name(name)
-    brmap[name]=n
-    return n
-
-  (revnode,_,user,(time,timezone),files,desc,branch,_)=get_changeset(ui,repo,revision,authors)
-  if user.find("<at>")!=-1:
-      user = "Evil Email <malformatted@us.er>"
-
-  branch=get_branchname(branch)
-
+    sys.stderr.write('Exported %d/%d files (%d new blobs)\n' % (count,max,sent))
+  return entries
+
+def copy_meta(repo,file,fnode):
+  """Return the (source,filenode) a file revision was copied from, None
+  if it is no copy. Like filelog.renamed() but only reads the metadata
+  of revisions stored as full texts."""
+  fl=repo.file(file)
+  # copies do not have a first parent
+  if fl.parents(fnode)[0]!=node.nullid:
+    return None
+  s=file_stream(repo,file,fnode)
+  if s==None:
+    return fl.renamed(fnode) or None
+  if s.meta==0:
+    return None
+  head=''
+  for piece in s.raw(False):
+    head+=piece
+    if len(head)>=s.meta:
+      break
+  meta=dict([l.split(': ',1) for l in head[2:s.meta-2].splitlines() if ': ' in l])
+  if 'copy' not in meta or 'copyrev' not in meta:
+    return None
+  return meta['copy'],node.bin(meta['copyrev'])
+
+def content_size(repo,file,fnode):
+  """Return the size of a file revision without its metadata. Only a
+  copy stored as a delta is read for it. A revision that is no copy but
+  has contents starting with \\1\\n counts its escape too, so it never
+  compares equal to a copy of it."""
+  s=file_stream(repo,file,fnode)
+  if s!=None:
+    return s.size
+  fl=repo.file(file)
+  if fl.parents(fnode)[0]!=node.nullid:
+    return file_size(repo,file,fnode)
+  return len(fl.read(fnode))
+
+def content_hash(repo,file,fnode):
+  """Return the SHA1 of the contents of a file revision, streaming them
+  if they are large"""
+  h=sha1()
+  for p in pieces(read_file(repo,file,fnode)):
+    h.update(p)
+  return h.digest()
+
+def copy_source(repo,file,fnode,flags,pman):
+  """Return the file a file revision was copied from if the copy is in
+  parent manifest pman with the same contents and flags, so that git
+  can copy it over from the parent's tree. None otherwise."""
+  if file=='.hgtags':
+    return None
+  r=copy_meta(repo,file,fnode)
+  if r==None:
+    return None
+  src,snode=r
+  if src=='.hgtags' or pman.get(src)!=snode or pman.flags(src)!=flags:
+    return None
+  gsrc,gdst=paths.map(src),paths.map(file)
+  if (gsrc==None or gdst==None or gsrc==gdst or
+      gdst.startswith(gsrc+'/') or gsrc.startswith(gdst+'/')):
+    return None
+  # the copy's revision has the copy metadata, compare the contents
+  if content_size(repo,src,snode)!=content_size(repo,file,fnode):
+    return None
+  if content_hash(repo,src,snode)!=content_hash(repo,file,fnode):
+    return None
+  return src
+
+def shared_paths(manifests):
+  """Return the git paths the path rules map more than one of the files
+  in manifests to. Which one git has there depends on the order they
+  were exported in, so they cannot be copied from."""
+  first={}
+  shared=set()
+  for man in manifests:
+    for file in man:
+      path=paths.map(file)
+      if path==None or file=='.hgtags':
+        continue
+      if first.setdefault(path,file)!=file:
+        shared.add(path)
+  return shared
+
+def find_copies(repo,man,parent,added,removed):
+  """Split the files copied or renamed unchanged from parent off added.
+  Returns the other added files and the copies as (command,source,file),
+  in the order git-fast-import has to apply them: all copies of a file
+  before it is renamed."""
+  pman=repo.changectx(str(parent)).manifest()
+  rest=[]
+  sources={}
+  shared=None
+  for file in added:
+    src=copy_source(repo,file,man[file],man.flags(file),pman)
+    if src!=None and len(paths)>0:
+      if shared==None:
+        shared=shared_paths([pman,man])
+      if paths.map(src) in shared or paths.map(file) in shared:
+        src=None
+    if src==None:
+      rest.append(file)
+    else:
+      sources.setdefault(src,[]).append(file)
+  copies=[]
+  for src in sorted(sources):
+    files=sources[src]
+    for file in files[:-1]:
+      copies.append(('C',src,file))
+    copies.append((src in removed and 'R' or 'C',src,files[-1]))
+  return rest,copies
+
+def quote_path(path):
+  """Quote a path for C and R commands, which split paths at spaces"""
+  if ' ' not in path and not path.startswith('"'):
+    return path
+  return '"%s"' % path.replace('\\','\\\\').replace('"','\\"')
+
+def get_parents(repo,revision):
   parents = [p for p in repo.changelog.parentrevs(revision) if p >= 0]
-
-  if len(parents)==0 and revision != 0:
-    wr('reset refs/heads/%s' % branch)
-
-  wr('commit refs/heads/%s' % branch)
-  wr('mark :%d' % (revision+1))
-  if sob:
-    wr('author %s %d %s' % (get_author(desc,user,authors),time,timezone))
-  wr('committer %s %d %s' % (user,time,timezone))
-  wr('data %d' % (len(desc)+1)) # wtf?
-  wr(desc)
-  wr()
-
-
   # Sort the parents based on revision ids so that we always get the
   # same resulting git repo, no matter how the revisions were
   # numbered.
   parents.sort(key=repo.changelog.node, reverse=True)
-
-  ctx=repo.changectx(str(revision))
-  man=ctx.manifest()
-  added,changed,removed,type=[],[],[],''
-
-  if len(parents) == 0:
-    # first revision: feed in full manifest
-    added=man.keys()
-    added.sort()
-    type='full'
-  else:
-    wr('from %s' % revnum_to_revref(parents[0], old_marks))
-    if len(parents) == 1:
+  return parents
+
+def get_changes(repo,revision,parents,budget=0):
+  """Find the files added, changed and removed by a revision.
+
+  Returns the kind of delta, the three lists, a dict mapping each
+  added or changed file to (filenode,flags,data) and the copies found
+  by find_copies(), which are not among the added files. File data is
+  read ahead only while it fits into budget bytes and is None
+  otherwise."""
+  added,changed,removed,copies,type=[],[],[],[],''
+  man,entries=None,None
+
+  with stats.phase('manifest'):
+    ctx=repo.changectx(str(revision))
+    if len(parents) == 0:
+      # first revision: feed in full manifest
+      man=ctx.manifest()
+      added=man.keys()
+      added.sort()
+      type='full'
+    elif len(parents) == 1:
       # later non-merge revision: feed in changed manifest
       # if we have exactly one parent, just take the changes from the
       # manifest without expensively comparing checksums
-      f=repo.status(repo.lookup(parents[0]),revnode)[:3]
+      man=ctx.manifest()
+      f=repo.status(repo.lookup(parents[0]),ctx.node())[:3]
       added,changed,removed=f[1],f[0],f[2]
       type='simple delta'
+      if cfg_copies:
+        added,copies=find_copies(repo,man,parents[0],added,removed)
     else: # a merge with two parents
-      wr('merge %s' % revnum_to_revref(parents[1], old_marks))
       # later merge revision: feed in changed manifest
       # for many files comparing checksums is expensive so only do it for
       # merges where we really need it due to hg's revlog logic
-      added,changed,removed=get_filechanges(repo,revision,parents,man)
+      added,changed,removed,entries=get_filechanges(repo,revision,parents)
       type='thorough delta'
 
+  info={}
+  for file in added+changed:
+    if entries!=None:
+      e=entries[file]
+      fnode,flags=node.bin(e[:40]),e[40:]
+    else:
+      fnode,flags=man[file],man.flags(file)
+    d=None
+    if budget>0 and file!='.hgtags' and paths.map(file)!=None:
+      with stats.phase('filedata'):
+        size=file_size(repo,file,fnode)
+        # large files are left to be streamed
+        if size<=budget and (cfg_stream_size<=0 or size<=cfg_stream_size):
+          d=repo.filectx(file,fileid=fnode).data()
+          budget-=len(d)
+    info[file]=(fnode,flags,d)
+  # in case the copies have to be sent as contents after all
+  for _,_,file in copies:
+    info[file]=(man[file],man.flags(file),None)
+  return type,added,changed,removed,info,copies
+
+def serial_changes(repo,min,max):
+  """Yield the changes of revisions min..max-1 as computed by get_changes()"""
+  for rev in range(min,max):
+    yield rev,get_changes(repo,rev,get_parents(repo,rev))
+
+# repository of a prefetch worker process
+prefetch_repo=None
+
+def prefetch_init(url):
+  global prefetch_repo
+  # only the main process writes stats
+  stats.detach()
+  _,prefetch_repo=setup_repo(url)
+
+def prefetch(revision,budget):
+  return get_changes(prefetch_repo,revision,get_parents(prefetch_repo,revision),budget)
+
+def prefetch_changes(repourl,min,max):
+  """Like serial_changes() but let a pool of worker processes, each with
+  the repository opened on its own, read the next revisions ahead"""
+  # the workers must not inherit anything still to be written
+  out.flush()
+  pool=Pool(cfg_prefetch_workers,prefetch_init,(repourl,))
+  # split the byte budget among the revisions in flight
+  budget=cfg_prefetch_bytes/cfg_prefetch_window or 1
+  pending=deque()
+  ahead=min
+  try:
+    for rev in range(min,max):
+      while ahead<max and len(pending)<cfg_prefetch_window:
+        pending.append(pool.apply_async(prefetch,(ahead,budget)))
+        ahead+=1
+      with stats.phase('prefetch'):
+        ch=pending.popleft().get()
+      yield rev,ch
+    pool.close()
+  finally:
+    pool.terminate()
+
+class BlobShards(object):
+  """git-fast-import processes importing only blobs, each into a pack
+  of its own, and exporting their marks to marksfile.<n>"""
+
+  def __init__(self,n,marksfile):
+    self.files=['%s.%d' % (marksfile,i) for i in range(n)]
+    self.procs=[subprocess.Popen(['git','fast-import','--quiet','--export-marks=%s' % f],
+        stdin=subprocess.PIPE) for f in self.files]
+    self.writers=[StreamWriter(p.stdin) for p in self.procs]
+    for w in self.writers:
+      w.stats=stats
+
+  def writer(self):
+    """Return the writer that has been given the fewest bytes"""
+    return min(self.writers,key=lambda w: w.bytes)
+
+  def close(self,old_marks):
+    """Wait for the importers and add their marks to old_marks"""
+    failed=0
+    for w,p in zip(self.writers,self.procs):
+      w.flush()
+      p.stdin.close()
+    for p,f in zip(self.procs,self.files):
+      if p.wait()!=0:
+        failed+=1
+      old_marks.import_text(f,cfg_mark_offset)
+      if os.path.exists(f):
+        os.unlink(f)
+    old_marks.commit()
+    return failed
+
+def export_blobs(repo,changes,marksfile,old_marks,blobs,counters):
+  """Send the blobs of all changes to cfg_blob_shards git-fast-import
+  processes compressing them in parallel. Returns the changes without
+  file data, for the commit pass referencing the blobs by SHA1."""
+  shards=BlobShards(cfg_blob_shards,marksfile)
+  l=[]
+  try:
+    for rev,ch in changes:
+      type,added,changed,removed,info,copies=ch
+      sys.stderr.write('Exporting blobs of revision %d\n' % rev)
+      export_file_contents(repo,added,info,old_marks,blobs,counters,shards)
+      export_file_contents(repo,changed,info,old_marks,blobs,counters,shards)
+      for f,(fnode,flags,d) in info.items():
+        info[f]=(fnode,flags,None)
+      l.append((rev,ch))
+  finally:
+    with stats.phase('shards'):
+      failed=shards.close(old_marks)
+  if failed:
+    sys.stderr.write('Error: %d blob importers failed\n' % failed)
+    return None
+  return l
+
+def export_commit(ui,repo,revision,changes,old_marks,max,count,authors,sob,brmap,blobs,counters,persist=None,moved=None):
+  def get_branchname(name):
+    if brmap.has_key(name):
+      return brmap[name]
+    n=sanitize_name(name)
+    brmap[name]=n
+    return n
+
+  with stats.phase('changelog'):
+    (revnode,_,user,(time,timezone),files,desc,branch,_)=get_changeset(ui,repo,revision,authors)
+  if user.find("<at>")!=-1:
+      user = "Evil Email <malformatted@us.er>"
+
+  branch=get_branchname(branch)
+
+  parents=get_parents(repo,revision)
+  type,added,changed,removed,info,copies=changes
+
   sys.stderr.write('%s: Exporting %s revision %d/%d with %d/%d/%d added/changed/removed files\n' %
       (branch,type,revision+1,max,len(added),len(changed),len(removed)))
 
-  map(lambda r: wr('D %s' % r),removed)
-  export_file_contents(ctx,man,added)
-  export_file_contents(ctx,man,changed)
-  wr()
+  # blobs have to be written before the commit referencing them
+  entries=export_file_contents(repo,added,info,old_marks,blobs,counters)
+  entries+=export_file_contents(repo,changed,info,old_marks,blobs,counters)
+
+  # the commits of the parents, or of what stands for them if pruned
+  marks=[]
+  for p in parents:
+    mark=old_marks.resolve(p+1)
+    if mark!=0 and mark not in marks:
+      marks.append(mark)
+  parents=[mark-1 for mark in marks]
+
+  # the copies are made in the tree of the first parent, if there is one
+  if copies and len(parents)==0:
+    entries+=export_file_contents(repo,[c[2] for c in copies],info,old_marks,blobs,counters)
+    copies=[]
+  renamed=[src for c,src,_ in copies if c=='R']
+  removed=[f for f in [paths.map(r) for r in removed if r not in renamed] if f!=None]
+
+  if (cfg_prune_empty and len(parents)<2 and len(entries)==0 and len(removed)==0
+      and len(copies)==0):
+    sys.stderr.write('%s: Pruning empty revision %d\n' % (branch,revision+1))
+    old_marks.alias(revision+1,marks and marks[0] or 0)
+    return count
+  old_marks.unalias(revision+1)
 
-  return checkpoint(count)
+  if len(parents)==0 and revision != 0:
+    out.command('reset refs/heads/%s' % branch)
 
-def export_tags(ui,repo,old_marks,mapping_cache,count,authors):
+  out.command('commit refs/heads/%s' % branch)
+  out.line('mark %s' % markref(revision+1))
+  if moved!=None:
+    moved.add(branch)
+  if sob:
+    out.line('author %s %d %s' % (get_author(desc,user,authors),time,timezone))
+  out.line('committer %s %d %s' % (user,time,timezone))
+  out.data(desc,'\n') # wtf?
+
+  if len(parents) > 0:
+    out.line('from %s' % revnum_to_revref(parents[0], old_marks))
+  if len(parents) > 1:
+    out.line('merge %s' % revnum_to_revref(parents[1], old_marks))
+
+  # C and R take the files as in the parent, after the removals so that
+  # these do not take away what they create, before the changes
+  map(lambda r: out.line('D %s' % r),removed)
+  for c,src,file in copies:
+    out.line('%s %s %s' % (c,quote_path(paths.map(src)),quote_path(paths.map(file))))
+  map(lambda e: out.line('M %s %s %s' % e),entries)
+  out.line()
+
+  return checkpoint(count,persist,revision+1)
+
+def load_tags(tagsfile,mapping_cache,old_marks):
+  """Return the tag index of the last run, tag -> hex hg node. Tags git
+  does not have at the commit of their node are left out, so they are
+  exported again."""
+  tags=load_cache(tagsfile)
+  for tag,node in tags.items():
+    rev=mapping_cache.find(node.decode('hex_codec'))
+    if rev<0 or get_git_sha1(get_tag(tag),'tags')!=revnum_to_revref(rev,old_marks):
+      del tags[tag]
+  return tags
+
+def export_tags(ui,repo,old_marks,mapping_cache,count,authors,tags):
+  """Export the tags added or moved since the run tags is the index of,
+  and delete the ones removed in hg. Updates tags to match."""
+  seen=set()
   l=repo.tagslist()
   for tag,node in l:
     tag=sanitize_name(tag,"tag")
     # ignore latest revision
     if tag=='tip': continue
+    seen.add(tag)
+    if tags.get(tag)==node.encode('hex_codec'): continue
     # ignore tags to nodes that are missing (ie, 'in the future')
-    if node.encode('hex_codec') not in mapping_cache:
+    rev=mapping_cache.find(node)
+    if rev<0:
       sys.stderr.write('Tag %s refers to unseen node %s\n' % (tag, node.encode('hex_codec')))
       continue
 
-    rev=int(mapping_cache[node.encode('hex_codec')])
-
     ref=revnum_to_revref(rev, old_marks)
     if ref==None:
       sys.stderr.write('Failed to find reference for creating tag'
           ' %s at r%d\n' % (tag,rev))
       continue
-    sys.stderr.write('Exporting tag [%s] at [hg r%d] [git %s]\n' % (tag,rev,ref))
-    wr('reset refs/tags/%s' % tag)
-    wr('from %s' % ref)
-    wr()
+    sys.stderr.write('Exporting tag [%s] at [hg r%d] [git %s]\n' % (get_tag(tag),rev,ref))
+    out.command('reset refs/tags/%s' % get_tag(tag))
+    out.line('from %s' % ref)
+    out.line()
+    tags[tag]=node.encode('hex_codec')
     count=checkpoint(count)
-  return count
 
-def load_authors(filename):
-  cache={}
-  if not os.path.exists(filename):
-    return cache
-  f=open(filename,'r')
-  l=0
-  lre=re.compile('^([^=]+)[ ]*=[ ]*(.+)$')
-  for line in f.readlines():
-    l+=1
-    m=lre.match(line)
-    if m==None:
-      sys.stderr.write('Invalid file format in [%s], line %d\n' % (filename,l))
-      continue
-    # put key:value in cache, key without ^:
-    cache[m.group(1).strip()]=m.group(2).strip()
-  f.close()
-  sys.stderr.write('Loaded %d authors\n' % l)
-  return cache
+  # a from of the null SHA1 deletes the ref
+  for tag in [t for t in tags.keys() if t not in seen]:
+    sys.stderr.write('Deleting tag [%s]\n' % get_tag(tag))
+    out.command('reset refs/tags/%s' % get_tag(tag))
+    out.line('from %s' % ('0'*40))
+    out.line()
+    del tags[tag]
+    count=checkpoint(count)
+  return count
 
 def verify_heads(ui,repo,cache,force):
   branches=repo.branchtags()
@@ -301,13 +797,107 @@ def verify_heads(ui,repo,cache,force):
 
   return True
 
-def hg2git(repourl,m,marksfile,mappingfile,headsfile,tipfile,authors={},sob=False,force=False):
-  _max=int(m)
+def mapping_valid(repo,mapping_cache,tip):
+  """Cheaply check that the mapping of an earlier run holds revisions
+  0..tip-1 (and maybe more, after a checkpoint) of this repository by
+  looking at both ends"""
+  n=len(mapping_cache)
+  if n<tip:
+    return False
+  if n==0:
+    return True
+  cl=repo.changelog
+  if n>len(cl):
+    return False
+  return mapping_cache[0]==cl.node(0) and mapping_cache[n-1]==cl.node(n-1)
+
+def update_mapping(repo,mapping_cache,tip,max):
+  """Extend the hg-to-rev mapping of the revisions before tip up to
+  revision max-1 with the nodes from the changelog index, rebuilding it
+  if it looks inconsistent"""
+  if not mapping_valid(repo,mapping_cache,tip):
+    sys.stderr.write('Rebuilding inconsistent hg revision mapping\n')
+    mapping_cache.truncate(0)
+  cl=repo.changelog
+  for rev in range(len(mapping_cache),max):
+    mapping_cache.append(cl.node(rev))
+
+def durable_tip(old_marks,tip):
+  """Return the number of revisions from 0 on that git-fast-import has
+  marks for, at most tip. Less than tip if it did not get to process the
+  last checkpoint we saved our state at."""
+  while tip>0 and not old_marks.exported(tip):
+    tip-=1
+  return tip
+
+def stop_watch(signum,frame):
+  global stop_watching
+  stop_watching=True
+
+def wait_for_revisions(repo,tip,mapping_cache):
+  """Wait until the changelog has more than tip revisions and return
+  their number, or None when asked to stop. It is looked at every
+  cfg_watch seconds and only read again when its index changed. Returns
+  -1 if revision tip-1 is gone or no longer the one exported (the
+  repository was stripped or rolled back)."""
+  index=repo.sjoin('00changelog.i')
+  last=None
+  while not stop_watching:
+    try:
+      st=os.stat(index)
+      now=(st.st_size,st.st_mtime)
+    except OSError:
+      now=None
+    if now!=last:
+      last=now
+      # the changelog, tags and branch caches are read again on demand
+      repo.invalidate()
+      if tip>0 and (len(repo)<tip or repo.changelog.node(tip-1)!=mapping_cache[tip-1]):
+        sys.stderr.write('Error: r%d of the repository is not the one exported, '
+            'run hg-reset.sh first\n' % (tip-1))
+        return -1
+      if len(repo)>tip:
+        return len(repo)
+    time.sleep(cfg_watch)
+  return None
+
+def wait_for_heads(moved,cache,force):
+  """Wait until git-fast-import has moved the branches in moved away
+  from their SHA1s in cache, as it does at a checkpoint, and put their
+  new SHA1s into cache. Returns False if it does not within a minute."""
+  deadline=time.time()+60
+  while True:
+    reset_git_refs()
+    waiting=[b for b in moved if get_git_sha1(b)==cache.get(b)]
+    if not waiting or time.time()>deadline:
+      break
+    if stop_watching:
+      return True
+    time.sleep(0.1)
+  for b in waiting:
+    sys.stderr.write('Error: git-fast-import did not update branch [%s]\n' % b)
+  if waiting and not force:
+    return False
+  for b in moved:
+    cache[b]=get_git_sha1(b)
+  return True
 
-  old_marks=load_cache(marksfile,lambda s: int(s)-1)
-  mapping_cache=load_cache(mappingfile)
+def hg2git(repourl,m,marksfile,mappingfile,headsfile,tipfile,blobsfile=None,authors=None,sob=False,force=False,usersfile=None,tagsfile=None):
+  _max=int(m)
+  # the stream may be shared with other repositories of a manifest
+  issued=(out.commands,out.bytes)
+
+  old_marks=Marks(marksfile)
+  mapping_cache=open_mapping(mappingfile)
+  blobs={}
+  if blobsfile!=None:
+    blobs=load_blobs(blobsfile,old_marks)
   heads_cache=load_cache(headsfile)
   state_cache=load_cache(tipfile)
+  if authors==None:
+    authors=AuthorMap()
+  if usersfile!=None:
+    authors.load_cache(usersfile)
 
   ui,repo=setup_repo(repourl)
 
@@ -320,29 +910,138 @@ def hg2git(repourl,m,marksfile,mappingfile,headsfile,tipfile,authors={},sob=Fals
     tip=len(repo)
 
   min=int(state_cache.get('tip',0))
+  durable=durable_tip(old_marks,min)
+  if durable<min:
+    sys.stderr.write('Resuming after r%d, the last revision git-fast-import has a mark for\n' %
+        (durable-1))
+    min=durable
   max=_max
   if _max<0 or max>tip:
     max=tip
 
-  for rev in range(0,max):
-  	(revnode,_,_,_,_,_,_,_)=get_changeset(ui,repo,rev,authors)
-  	mapping_cache[revnode.encode('hex_codec')] = str(rev)
-
+  def persist(tip):
+    # the tip goes last, it declares the rest complete
+    mapping_cache.commit()
+    old_marks.aliases.commit()
+    if blobsfile!=None:
+      blobs.commit()
+    if usersfile!=None:
+      authors.save_cache(usersfile)
+    state_cache['tip']=tip
+    state_cache['repo']=repourl
+    save_cache(tipfile,state_cache)
 
   c=0
   brmap={}
-  for rev in range(min,max):
-    c=export_commit(ui,repo,rev,old_marks,max,c,authors,sob,brmap)
+  counters={'blob':next_blob_mark(blobs,old_marks)}
+  tags={}
+  moved=set()
+  if cfg_export_tags and tagsfile!=None:
+    tags=load_tags(tagsfile,mapping_cache,old_marks)
+  while True:
+    with stats.phase('changelog'):
+      update_mapping(repo,mapping_cache,min,max)
+
+    if cfg_prefetch_workers>0:
+      changes=prefetch_changes(repourl,min,max)
+    else:
+      changes=serial_changes(repo,min,max)
+    if cfg_blob_shards>0:
+      changes=export_blobs(repo,changes,marksfile,old_marks,blobs,counters)
+      if changes==None:
+        return 1
+    for rev,ch in changes:
+      c=export_commit(ui,repo,rev,ch,old_marks,max,c,authors,sob,brmap,blobs,counters,persist,moved)
+      stats.count('revisions')
+      stats.tick()
+
+    persist(max)
+
+    if cfg_export_tags:
+      with stats.phase('tags'):
+        c=export_tags(ui,repo,old_marks,mapping_cache,c,authors,tags)
+        if tagsfile!=None:
+          save_cache(tagsfile,tags)
+
+    if cfg_watch<=0 or _max>=0:
+      break
+
+    # have git-fast-import update the refs now, then wait for more
+    out.command('checkpoint')
+    out.line()
+    out.flush()
+    # what is checked next is that nobody else moved the branches since
+    if not wait_for_heads(moved,heads_cache,force):
+      return 1
+    moved.clear()
+    sys.stderr.write('Exported up to r%d, watching for new revisions\n' % (max-1))
+    tip=wait_for_revisions(repo,max,mapping_cache)
+    if tip==None:
+      break
+    if tip<0:
+      return 1
+    # check against what hg and git have now
+    repo.invalidate()
+    reset_git_refs()
+    if not verify_heads(ui,repo,heads_cache,force):
+      return 1
+    min,max=max,tip
+
+  out.flush()
+  sys.stderr.write('Issued %d commands, wrote %d bytes\n' %
+      (out.commands-issued[0],out.bytes-issued[1]))
 
-  state_cache['tip']=max
-  state_cache['repo']=repourl
-  save_cache(tipfile,state_cache)
-  save_cache(mappingfile,mapping_cache)
-
-  c=export_tags(ui,repo,old_marks,mapping_cache,c,authors)
-
-  sys.stderr.write('Issued %d commands\n' % c)
+  return 0
 
+def configure_repo(options):
+  """Set up what may differ per repository from options, return the
+  author map"""
+  global paths,cfg_prune_empty,cfg_export_tags
+  set_default_branch(options.default_branch or 'master')
+  set_origin_name(options.origin_name or '')
+  set_tag_namespace('')
+  paths=no_paths
+  if options.pathrulesfile!=None:
+    paths=load_path_rules(options.pathrulesfile)
+  cfg_prune_empty=options.prune_empty
+  cfg_export_tags=options.export_tags
+  manifest_cache.clear()
+  if options.authorfile!=None:
+    return load_authors(options.authorfile)
+  return None
+
+def export_manifest(filename,parser,options):
+  """Export all repositories listed in filename into the one stream.
+  Every line is the URL of a repository, the prefix of the files to keep
+  its state in (PREFIX-marks, -mapping, -heads, -state, -blobs, -users
+  and -tags) and optionally options for it, which override those given on
+  the command line"""
+  global cfg_mark_offset
+  f=open(filename,'r')
+  lines=[l for l in f.readlines() if l.strip()!='' and not l.lstrip().startswith('#')]
+  f.close()
+  failed=0
+  for k,line in enumerate(lines):
+    (o,args)=parser.parse_args(shlex.split(line),copy.copy(options))
+    if len(args)!=2:
+      sys.stderr.write('Invalid file format in [%s], entry %d\n' % (filename,k+1))
+      failed+=1
+      continue
+    repourl,prefix=args
+    sys.stderr.write('Exporting %s\n' % repourl)
+    a=configure_repo(o)
+    # the tags go below -o too, lest those of two repositories clash
+    set_tag_namespace(o.origin_name or '')
+    cfg_mark_offset=k<<32
+    m=-1
+    if o.max!=None: m=o.max
+    if hg2git(repourl,m,prefix+'-marks',prefix+'-mapping',prefix+'-heads',
+        prefix+'-state',blobsfile=prefix+'-blobs',authors=a,sob=o.sob,force=o.force,
+        usersfile=prefix+'-users',tagsfile=prefix+'-tags')!=0:
+      failed+=1
+  if failed:
+    sys.stderr.write('Error: %d of %d repositories failed\n' % (failed,len(lines)))
+    return 1
   return 0
 
 if __name__=='__main__':
@@ -363,12 +1062,56 @@ if __name__=='__main__':
       help="File to read last run's git heads from")
   parser.add_option("--status",dest="statusfile",
       help="File to read status from")
+  parser.add_option("--blobs",dest="blobsfile",
+      help="File to read last run's blob marks from")
+  parser.add_option("--hash-blobs",action="store_true",dest="hash_blobs",
+      default=False,help="Also deduplicate blobs by content")
+  parser.add_option("-j","--prefetch-workers",type="int",dest="prefetch_workers",
+      help="Number of worker processes reading revisions ahead")
+  parser.add_option("--prefetch-window",type="int",dest="prefetch_window",
+      help="Number of revisions to read ahead")
+  parser.add_option("--prefetch-bytes",type="int",dest="prefetch_bytes",
+      help="Maximum bytes of file data to read ahead")
+  parser.add_option("--stats",dest="statsfile",
+      help="Append performance records as JSON lines to STATSFILE")
+  parser.add_option("--stats-interval",type="float",dest="stats_interval",
+      help="Seconds between two performance records")
+  parser.add_option("--profile",dest="profiledir",
+      help="Dump a cProfile profile of each phase into PROFILEDIR")
+  parser.add_option("--blob-shards",type="int",dest="blob_shards",
+      help="Import blobs first with BLOB_SHARDS parallel git-fast-import processes")
+  parser.add_option("--stream-size",type="int",dest="stream_size",
+      help="Stream files larger than STREAM_SIZE bytes instead of reading them (0: never)")
+  parser.add_option("--side-store",dest="side_store",
+      help="Move large files to SIDE_STORE and export git-lfs pointers instead")
+  parser.add_option("--side-store-size",type="int",dest="side_store_size",
+      help="Size in bytes above which files go to the side store")
+  parser.add_option("--checkpoint-commits",type="int",dest="checkpoint_commits",
+      help="Checkpoint and save state every CHECKPOINT_COMMITS commits")
+  parser.add_option("--checkpoint-bytes",type="int",dest="checkpoint_bytes",
+      help="Checkpoint and save state every CHECKPOINT_BYTES bytes of stream")
   parser.add_option("-r","--repo",dest="repourl",
       help="URL of repo to import")
   parser.add_option("-s",action="store_true",dest="sob",
       default=False,help="Enable parsing Signed-off-by lines")
   parser.add_option("-A","--authors",dest="authorfile",
       help="Read authormap from AUTHORFILE")
+  parser.add_option("--users",dest="usersfile",
+      help="File to read last run's normalized user names from")
+  parser.add_option("--tags",dest="tagsfile",
+      help="File to keep the exported tags in, to only export changes")
+  parser.add_option("--path-rules",dest="pathrulesfile",
+      help="Map file paths by the rules in PATHRULESFILE")
+  parser.add_option("--prune-empty",action="store_true",dest="prune_empty",
+      default=False,help="Skip commits left without changes")
+  parser.add_option("--no-tags",action="store_false",dest="export_tags",
+      default=True,help="Do not export the tags")
+  parser.add_option("--manifest",dest="manifestfile",
+      help="Export all repositories listed in MANIFESTFILE")
+  parser.add_option("--copies",action="store_true",dest="copies",
+      default=False,help="Send unchanged copies and renames as C and R commands")
+  parser.add_option("--watch",type="float",dest="watch",
+      help="Keep running, looking for new revisions every WATCH seconds")
   parser.add_option("-f","--force",action="store_true",dest="force",
       default=False,help="Ignore validation errors by force")
   parser.add_option("-M","--default-branch",dest="default_branch",
@@ -378,24 +1121,63 @@ if __name__=='__main__':
 
   (options,args)=parser.parse_args()
 
-  m=-1
-  if options.max!=None: m=options.max
-
-  if options.marksfile==None: bail(parser,'--marks')
-  if options.mappingfile==None: bail(parser,'--mapping')
-  if options.headsfile==None: bail(parser,'--heads')
-  if options.statusfile==None: bail(parser,'--status')
-  if options.repourl==None: bail(parser,'--repo')
-
-  a={}
-  if options.authorfile!=None:
-    a=load_authors(options.authorfile)
-
-  if options.default_branch!=None:
-    set_default_branch(options.default_branch)
-
-  if options.origin_name!=None:
-    set_origin_name(options.origin_name)
-
-  sys.exit(hg2git(options.repourl,m,options.marksfile,options.mappingfile,options.headsfile,
-    options.statusfile,authors=a,sob=options.sob,force=options.force))
+  if options.manifestfile==None:
+    if options.marksfile==None: bail(parser,'--marks')
+    if options.mappingfile==None: bail(parser,'--mapping')
+    if options.headsfile==None: bail(parser,'--heads')
+    if options.statusfile==None: bail(parser,'--status')
+    if options.repourl==None: bail(parser,'--repo')
+
+  if options.hash_blobs:
+    cfg_hash_blobs=True
+
+  if options.copies:
+    cfg_copies=True
+
+  if options.blob_shards!=None:
+    cfg_blob_shards=options.blob_shards
+
+  if options.stream_size!=None:
+    cfg_stream_size=options.stream_size
+  if options.side_store!=None:
+    cfg_side_store=os.path.abspath(options.side_store)
+    if not os.path.isdir(cfg_side_store):
+      os.makedirs(cfg_side_store)
+  if options.side_store_size!=None:
+    cfg_side_store_size=options.side_store_size
+
+  if options.checkpoint_commits!=None:
+    cfg_checkpoint_count=options.checkpoint_commits
+  if options.checkpoint_bytes!=None:
+    cfg_checkpoint_bytes=options.checkpoint_bytes
+
+  if options.prefetch_workers!=None:
+    cfg_prefetch_workers=options.prefetch_workers
+  if options.prefetch_window!=None:
+    cfg_prefetch_window=options.prefetch_window
+  if options.prefetch_bytes!=None:
+    cfg_prefetch_bytes=options.prefetch_bytes
+
+  if options.watch!=None:
+    if options.manifestfile!=None:
+      parser.error('--watch cannot be used with --manifest')
+    cfg_watch=options.watch
+    # stop after the revisions being exported
+    signal.signal(signal.SIGINT,stop_watch)
+    signal.signal(signal.SIGTERM,stop_watch)
+
+  stats.open(options.statsfile,options.stats_interval,options.profiledir)
+  stats.gauge('bytes',lambda: out.bytes)
+  stats.gauge('commands',lambda: out.commands)
+
+  if options.manifestfile!=None:
+    r=export_manifest(options.manifestfile,parser,options)
+  else:
+    m=-1
+    if options.max!=None: m=options.max
+    a=configure_repo(options)
+    r=hg2git(options.repourl,m,options.marksfile,options.mappingfile,options.headsfile,
+      options.statusfile,blobsfile=options.blobsfile,authors=a,sob=options.sob,force=options.force,
+      usersfile=options.usersfile,tagsfile=options.tagsfile)
+  stats.close()
+  sys.exit(r)
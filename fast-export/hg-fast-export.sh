@@ -10,10 +10,13 @@ SFX_MAPPING="mapping"
 SFX_MARKS="marks"
 SFX_HEADS="heads"
 SFX_STATE="state"
+SFX_BLOBS="blobs"
+SFX_USERS="users"
+SFX_TAGS="tags"
 GFI_OPTS=""
 PYTHON=${PYTHON:-python}
 
-USAGE="[--quiet] [-r <repo>] [--force] [-m <max>] [-s] [-A <file>] [-M <name>] [-o <name>]"
+USAGE="[--quiet] [-r <repo>] [--force] [-m <max>] [-s] [-A <file>] [-M <name>] [-o <name>] [--watch <seconds>]"
 LONG_USAGE="Import hg repository <repo> up to either tip or <max>
 If <repo> is omitted, use last hg repository as obtained from state file,
 GIT_DIR/$PFX-$SFX_STATE by default.
@@ -31,6 +34,8 @@ Options:
 	-o	Use <name> as branch namespace to track upstream (eg 'origin')
 	--force Ignore validation errors when converting, and pass --force
 		to git-fast-import(1)
+	--watch	Keep running and import new revisions as they come,
+		looking for them every <seconds>; stop with SIGINT or SIGTERM
 "
 
 . "$(git --exec-path)/git-sh-setup"
@@ -74,34 +79,48 @@ if [ ! -f "$GIT_DIR/$PFX-$SFX_MARKS" ] ; then
 fi
 
 # cleanup on exit
-trap 'rm -f "$GIT_DIR/$PFX-$SFX_MARKS.old" "$GIT_DIR/$PFX-$SFX_MARKS.tmp"' 0
-
-GIT_DIR="$GIT_DIR" $PYTHON "$ROOT/hg-fast-export.py" \
-  --repo "$REPO" \
-  --marks "$GIT_DIR/$PFX-$SFX_MARKS" \
-  --mapping "$GIT_DIR/$PFX-$SFX_MAPPING" \
-  --heads "$GIT_DIR/$PFX-$SFX_HEADS" \
-  --status "$GIT_DIR/$PFX-$SFX_STATE" \
-  "$@" \
-| git fast-import $GFI_OPTS --export-marks="$GIT_DIR/$PFX-$SFX_MARKS.tmp" || exit 1
-
-# move recent marks cache out of the way...
-if [ -f "$GIT_DIR/$PFX-$SFX_MARKS" ] ; then
-  mv "$GIT_DIR/$PFX-$SFX_MARKS" "$GIT_DIR/$PFX-$SFX_MARKS.old"
-else
-  touch "$GIT_DIR/$PFX-$SFX_MARKS.old"
-fi
+trap 'rm -f "$GIT_DIR/$PFX-$SFX_MARKS.tmp" "$GIT_DIR/$PFX-$SFX_MARKS.exit"' 0
+
+# with --watch, SIGINT and SIGTERM only stop the exporter, after what
+# it is exporting; git-fast-import and this script then finish as usual
+case " $* " in
+  *" --watch"*)
+    trap '' INT TERM
+    ;;
+esac
+
+# the exit status of the exporter, sh has no pipefail
+echo 1 > "$GIT_DIR/$PFX-$SFX_MARKS.exit"
+{
+  GIT_DIR="$GIT_DIR" $PYTHON "$ROOT/hg-fast-export.py" \
+    --repo "$REPO" \
+    --marks "$GIT_DIR/$PFX-$SFX_MARKS" \
+    --mapping "$GIT_DIR/$PFX-$SFX_MAPPING" \
+    --heads "$GIT_DIR/$PFX-$SFX_HEADS" \
+    --status "$GIT_DIR/$PFX-$SFX_STATE" \
+    --blobs "$GIT_DIR/$PFX-$SFX_BLOBS" \
+    --users "$GIT_DIR/$PFX-$SFX_USERS" \
+    --tags "$GIT_DIR/$PFX-$SFX_TAGS" \
+    "$@"
+  echo $? > "$GIT_DIR/$PFX-$SFX_MARKS.exit"
+} | git fast-import $GFI_OPTS --export-marks="$GIT_DIR/$PFX-$SFX_MARKS.tmp"
+GFI_EXIT=$?
+EXPORT_EXIT="`cat "$GIT_DIR/$PFX-$SFX_MARKS.exit"`"
 
-# ...to create a new merged one
-cat "$GIT_DIR/$PFX-$SFX_MARKS.old" "$GIT_DIR/$PFX-$SFX_MARKS.tmp" \
-| uniq > "$GIT_DIR/$PFX-$SFX_MARKS"
+# add the marks of this run to the marks cache, even after a failure:
+# git-fast-import has written them as of its last checkpoint, which
+# the next run resumes after
+$PYTHON "$ROOT/revstore.py" import-marks \
+  "$GIT_DIR/$PFX-$SFX_MARKS" "$GIT_DIR/$PFX-$SFX_MARKS.tmp" || exit 1
 
 # save SHA1s of current heads for incremental imports
 # and connectivity (plus sanity checking)
-for head in `git branch | sed 's#^..##'` ; do
-  id="`git rev-parse $head`"
-  echo ":$head $id"
-done > "$GIT_DIR/$PFX-$SFX_HEADS"
+git for-each-ref --format=':%(refname) %(objectname)' refs/heads \
+| sed 's#^:refs/heads/#:#' > "$GIT_DIR/$PFX-$SFX_HEADS"
+
+if [ "$GFI_EXIT" != 0 -o "$EXPORT_EXIT" != 0 ] ; then
+  exit 1
+fi
 
 # check diff with color:
 # ( for i in `find . -type f | grep -v '\.git'` ; do diff -u $i $REPO/$i ; done | cdiff ) | less -r
@@ -3,48 +3,103 @@
 # Copyright (c) 2007, 2008 Rocco Rutte <pdmef@gmx.net> and others.
 # License: GPLv2
 
-from mercurial import node
-from hg2git import setup_repo,load_cache,get_changeset,get_git_sha1
+from hg2git import setup_repo,load_cache,save_cache,get_changeset,get_git_sha1
+from hg2git import get_branch,sanitize_name,load_authors
+from revstore import Marks,RevTable,open_mapping,save_text
 from optparse import OptionParser
+from array import array
+from binascii import hexlify
+import subprocess
+import struct
 import sys
+import os
 
-def heads(ui,repo,start=None,stop=None,max=None):
-  # this is copied from mercurial/revlog.py and differs only in
-  # accepting a max argument for xrange(startrev+1,...) defaulting
-  # to the original repo.changelog.count()
-  if start is None:
-    start = node.nullid
-  if stop is None:
-    stop = []
-  if max is None:
-    max = repo.changelog.count()
-  stoprevs = dict.fromkeys([repo.changelog.rev(n) for n in stop])
-  startrev = repo.changelog.rev(start)
-  reachable = {startrev: 1}
-  heads = {startrev: 1}
-
-  parentrevs = repo.changelog.parentrevs
-  for r in xrange(startrev + 1, max):
-    for p in parentrevs(r):
-      if p in reachable:
-        if r not in stoprevs:
-          reachable[r] = 1
-        heads[r] = 1
-      if p in heads and p not in stoprevs:
-        del heads[p]
-
-  return [(repo.changelog.node(r),str(r)) for r in heads]
-
-def get_branches(ui,repo,heads_cache,marks_cache,mapping_cache,max):
-  h=heads(ui,repo,max=max)
+class Dag(object):
+  """Parents and branch of every revision as flat arrays, cached across
+  runs in a RevTable of (p1+1,p2+1,branch+1) records by revision. The
+  branch names go to filename-branches, after a '# rev node' line
+  naming the last revision the table is complete and valid for."""
+
+  record=struct.Struct('<iii')
+
+  def __init__(self,filename):
+    self.table=RevTable(filename,self.record.size)
+    self.namesfile=filename+'-branches'
+    self.names=[]
+    self.last=None
+    if os.path.exists(self.namesfile):
+      f=open(self.namesfile,'r')
+      fields=f.readline().split()
+      if len(fields)==3 and fields[0]=='#':
+        self.last=(int(fields[1]),fields[2])
+        self.names=[line.rstrip('\n') for line in f]
+      f.close()
+    self.index=dict([(name,i) for i,name in enumerate(self.names)])
+
+  def update(self,repo,n):
+    """Make the arrays hold revisions 0..n-1, reading only those the
+    cache does not have yet. Starts over if the repository does not
+    have the revisions the cache was built from anymore."""
+    cl=repo.changelog
+    m=0
+    if self.last!=None:
+      rev,hexnode=self.last
+      if rev<len(cl) and hexlify(cl.node(rev))==hexnode:
+        m=rev+1
+    if m==0:
+      self.names,self.index=[],{}
+    self.table.truncate(m)
+    for r in xrange(m,n):
+      p1,p2=cl.parentrevs(r)
+      branch=cl.read(cl.node(r))[5].get('branch','master')
+      i=self.index.get(branch)
+      if i==None:
+        i=self.index[branch]=len(self.names)
+        self.names.append(branch)
+      self.table.append(self.record.pack(p1+1,p2+1,i+1))
+    if n>m:
+      self.table.commit()
+      # the names go last, their header declares the table complete
+      save_text(self.namesfile,['# %d %s\n' % (n-1,hexlify(cl.node(n-1)))]+
+          ['%s\n' % name for name in self.names])
+    a=array('i')
+    a.fromstring(self.table.raw(n))
+    if sys.byteorder=='big':
+      a.byteswap()
+    self.p1,self.p2,self.branch=a[0::3],a[1::3],a[2::3]
+
+  def heads(self,cutoff):
+    """Return branch name -> revisions below cutoff on that branch
+    without a child on it below cutoff, in increasing order. The last
+    one is the revision hg-fast-export left the branch at."""
+    br=self.branch
+    closed=bytearray(cutoff)
+    for parents in (self.p1,self.p2):
+      for r in xrange(cutoff):
+        p=parents[r]
+        if p and br[p-1]==br[r]:
+          closed[p-1]=1
+    heads={}
+    r=closed.find(b'\0')
+    while r>=0:
+      heads.setdefault(self.names[br[r]-1],[]).append(r)
+      r=closed.find(b'\0',r+1)
+    return heads
+
+def get_branches(ui,repo,dag,heads_cache,marks_cache,max,authors=None):
   stale=dict.fromkeys(heads_cache)
   changed=[]
   unchanged=[]
-  for node,rev in h:
-    _,_,user,(_,_),_,desc,branch,_=get_changeset(ui,repo,rev)
-    del stale[branch]
+  for branch,revs in dag.heads(max).items():
+    # heads are cached and exported under their sanitized names
+    branch=sanitize_name(get_branch(branch))
+    if len(revs)>1:
+      sys.stderr.write('Warning: branch [%s] has %d heads below r%d\n' % (branch,len(revs),max))
+    rev=revs[-1]
+    stale.pop(branch,None)
+    _,_,user,(_,_),_,desc,_,_=get_changeset(ui,repo,rev,authors)
     git_sha1=get_git_sha1(branch)
-    cache_sha1=marks_cache.get(str(int(rev)+1))
+    cache_sha1=marks_cache.get(rev+1)
     if git_sha1!=None and git_sha1==cache_sha1:
       unchanged.append([branch,cache_sha1,rev,desc.split('\n')[0],user])
     else:
@@ -53,15 +108,17 @@ def get_branches(ui,repo,heads_cache,marks_cache,mapping_cache,max):
   unchanged.sort()
   return stale,changed,unchanged
 
-def get_tags(ui,repo,marks_cache,mapping_cache,max):
+def get_tags(ui,repo,marks_cache,mapping_cache,max,authors=None):
   l=repo.tagslist()
   good,bad=[],[]
   for tag,node in l:
     if tag=='tip': continue
-    rev=int(mapping_cache[node.encode('hex_codec')])
-    cache_sha1=marks_cache.get(str(int(rev)+1))
-    _,_,user,(_,_),_,desc,branch,_=get_changeset(ui,repo,rev)
-    if int(rev)>int(max):
+    rev=mapping_cache.find(node)
+    if rev<0: continue
+    cache_sha1=marks_cache.get(rev+1)
+    _,_,user,(_,_),_,desc,branch,_=get_changeset(ui,repo,rev,authors)
+    tag,branch=sanitize_name(tag,"tag"),sanitize_name(branch)
+    if rev>=max:
       bad.append([tag,branch,cache_sha1,rev,desc.split('\n')[0],user])
     else:
       good.append([tag,branch,cache_sha1,rev,desc.split('\n')[0],user])
@@ -69,8 +126,70 @@ def get_tags(ui,repo,marks_cache,mapping_cache,max):
   bad.sort()
   return good,bad
 
-def mangle_mark(mark):
-  return str(int(mark)-1)
+def dropped_blobs(marks_cache,max):
+  """Return the SHA1s of the blobs the commits of revisions max and
+  later add or change, None if git diff-tree fails. Once these commits
+  are pruned, so may be the blobs."""
+  p=subprocess.Popen(['git','diff-tree','--stdin','-r','-m','--root','--no-commit-id'],
+      stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+  out=p.communicate(''.join([c+'\n' for c in marks_cache.commits_from(max)]))[0]
+  if p.returncode!=0:
+    return None
+  blobs=set()
+  for line in out.splitlines():
+    # :mode mode sha1 sha1 status\tpath
+    fields=line.split('\t',1)[0].split()
+    if line.startswith(':') and fields[1]!='160000' and fields[3]!='0'*40:
+      blobs.add(fields[3])
+  return blobs
+
+def apply_reset(stale,changed,unchanged,bad,marks_cache,mapping_cache,
+    state_cache,headsfile,statusfile,max):
+  """Roll the import back to revisions 0..max-1: move the git refs,
+  then rewrite the state, heads, marks and mapping files, each
+  atomically. Safe to run again if interrupted."""
+  blobs=dropped_blobs(marks_cache,max)
+  if blobs==None:
+    sys.stderr.write('Error: git diff-tree failed\n')
+    return False
+
+  refs=[]
+  for b in changed:
+    if b[1]==None:
+      sys.stderr.write('Error: no mark for r%d, branch [%s]\n' % (b[2],b[0]))
+      return False
+    refs.append('update refs/heads/%s %s\n' % (b[0],b[1]))
+  for b in stale.keys():
+    refs.append('delete refs/heads/%s\n' % b)
+  for t in bad:
+    if get_git_sha1(t[0],'tags')!=None:
+      refs.append('delete refs/tags/%s\n' % t[0])
+
+  # a lower tip goes first, it makes all the rest superfluous
+  state_cache['tip']=max
+  save_cache(statusfile,state_cache)
+
+  if refs:
+    # one transaction: all refs move or none
+    p=subprocess.Popen(['git','update-ref','--stdin'],stdin=subprocess.PIPE)
+    p.communicate(''.join(refs))
+    if p.returncode!=0:
+      sys.stderr.write('Error: git update-ref failed\n')
+      return False
+
+  heads={}
+  for b in changed+unchanged:
+    heads[b[0]]=b[1]
+  save_cache(headsfile,heads)
+
+  # the next export sends the blobs again rather than trusting git
+  # still has them; the blob keys of forgotten marks are dropped on load
+  marks_cache.forget_blobs(blobs)
+  marks_cache.truncate(max)
+  marks_cache.commit()
+  mapping_cache.truncate(max)
+  mapping_cache.commit()
+  return True
 
 if __name__=='__main__':
   def bail(parser,opt):
@@ -82,6 +201,8 @@ if __name__=='__main__':
 
   parser.add_option("--marks",dest="marksfile",
       help="File to read git-fast-import's marks from")
+  parser.add_option("--mapping",dest="mappingfile",
+      help="File to read last run's hg-to-git SHA1 mapping")
   parser.add_option("--heads",dest="headsfile",
       help="File to read last run's git heads from")
   parser.add_option("--status",dest="statusfile",
@@ -90,17 +211,26 @@ if __name__=='__main__':
       help="URL of repo to import")
   parser.add_option("-R","--revision",type=int,dest="revision",
       help="Revision to reset to")
+  parser.add_option("-A","--authors",dest="authorfile",
+      help="Read authormap from AUTHORFILE")
+  parser.add_option("--dag",dest="dagfile",
+      help="File to cache the parents and branch of every revision in "
+      "(default: MAPPINGFILE-dag)")
+  parser.add_option("--apply",action="store_true",dest="apply",
+      default=False,help="Reset refs and state files instead of printing how")
 
   (options,args)=parser.parse_args()
 
   if options.marksfile==None: bail(parser,'--marks option')
+  if options.mappingfile==None: bail(parser,'--mapping option')
   if options.headsfile==None: bail(parser,'--heads option')
   if options.statusfile==None: bail(parser,'--status option')
   if options.repourl==None: bail(parser,'--repo option')
   if options.revision==None: bail(parser,'-R/--revision')
 
   heads_cache=load_cache(options.headsfile)
-  marks_cache=load_cache(options.marksfile,mangle_mark)
+  marks_cache=Marks(options.marksfile)
+  mapping_cache=open_mapping(options.mappingfile)
   state_cache=load_cache(options.statusfile)
 
   l=int(state_cache.get('tip',options.revision))
@@ -108,10 +238,20 @@ if __name__=='__main__':
     sys.stderr.write('Revision is beyond last revision imported: %d>%d\n' % (options.revision,l))
     sys.exit(1)
 
+  a=None
+  if options.authorfile!=None:
+    a=load_authors(options.authorfile)
+
   ui,repo=setup_repo(options.repourl)
 
-  stale,changed,unchanged=get_branches(ui,repo,heads_cache,marks_cache,mapping_cache,options.revision+1)
-  good,bad=get_tags(ui,repo,marks_cache,mapping_cache,options.revision+1)
+  max=options.revision+1
+  if options.dagfile==None:
+    options.dagfile=options.mappingfile+'-dag'
+  dag=Dag(options.dagfile)
+  dag.update(repo,max)
+
+  stale,changed,unchanged=get_branches(ui,repo,dag,heads_cache,marks_cache,max,a)
+  good,bad=get_tags(ui,repo,marks_cache,mapping_cache,max,a)
 
   print "Possibly stale branches:"
   map(lambda b: sys.stdout.write('\t%s\n' % b),stale.keys())
@@ -125,7 +265,16 @@ if __name__=='__main__':
   print "Unchanged tags:"
   map(lambda b: sys.stdout.write('\t%s on %s (r%s)\n' % (b[0],b[1],b[3])),good)
 
-  print "Reset branches in '%s' to:" % options.headsfile
+  if options.apply:
+    if not apply_reset(stale,changed,unchanged,bad,marks_cache,mapping_cache,
+        state_cache,options.headsfile,options.statusfile,max):
+      sys.exit(1)
+    print "Reset branches to:"
+  else:
+    print "Reset branches in '%s' to:" % options.headsfile
   map(lambda b: sys.stdout.write('\t:%s %s\n\t\t(r%s: %s: %s)\n' % (b[0],b[1],b[2],b[4],b[3])),changed)
 
-  print "Reset ':tip' in '%s' to '%d'" % (options.statusfile,options.revision)
+  if options.apply:
+    print "Reset ':tip' to '%d', next import starts at r%d" % (max,max)
+  else:
+    print "Reset ':tip' in '%s' to '%d'" % (options.statusfile,max)
@@ -13,7 +13,7 @@ SFX_STATE="state"
 QUIET=""
 PYTHON=${PYTHON:-python}
 
-USAGE="[-r <repo>] -R <rev>"
+USAGE="[-r <repo>] -R <rev> [--apply]"
 LONG_USAGE="Print SHA1s of latest changes per branch up to <rev> useful
 to reset import and restart at <rev>.
 If <repo> is omitted, use last hg repository as obtained from state file,
@@ -22,6 +22,7 @@ GIT_DIR/$PFX-$SFX_STATE by default.
 Options:
 	-R	Hg revision to reset to
 	-r	Mercurial repository to use
+	--apply	Reset branches and state files instead of printing how
 "
 
 . "$(git --exec-path)/git-sh-setup"
@@ -3,19 +3,40 @@
 # Copyright (c) 2007, 2008 Rocco Rutte <pdmef@gmx.net> and others.
 # License: MIT <http://www.opensource.org/licenses/mit-license.php>
 
-from mercurial import hg,util,ui,templatefilters
+from mercurial import hg,util,ui,templatefilters,revlog
+from revstore import save_text
+from collections import OrderedDict
+from hashlib import sha1
 import re
 import os
 import sys
+import zlib
 
 # default git branch name
 cfg_master='master'
 # default origin name
 origin_name=''
+# name the tags go below, if any
+tag_namespace=''
 # silly regex to see if user field has email address
 user_re=re.compile('([^<]+) (<[^>]*>)$')
 # silly regex to clean out user names
 user_clean_re=re.compile('^["]([^"]+)["]$')
+# regex to parse author map lines
+author_line_re=re.compile('^([^=]+)[ ]*=[ ]*(.+)$')
+# regex to parse path rule lines
+path_rule_re=re.compile('^(move|re):([^=]*)=(.*)$|^(drop):(.+)$')
+# characters and sequences git-check-ref-format(1) rejects
+ref_bad_re=re.compile('([[ ~^:?*]|\.\.)')
+ref_underscores_re=re.compile('_+')
+# number of raw user strings an author map remembers the normalized form of
+cfg_user_cache=100000
+# sanitized ref names: (what,name) -> name
+sanitized={}
+# size of the pieces a file revision is streamed in
+cfg_chunk_size=1<<20
+# snapshot of the git repository's refs: full ref name -> SHA1
+git_refs=None
 
 def set_default_branch(name):
   global cfg_master
@@ -25,6 +46,10 @@ def set_origin_name(name):
   global origin_name
   origin_name = name
 
+def set_tag_namespace(name):
+  global tag_namespace
+  tag_namespace = name
+
 def setup_repo(url):
   try:
     myui=ui.ui(interactive=False)
@@ -33,7 +58,165 @@ def setup_repo(url):
     myui.setconfig('ui', 'interactive', 'off')
   return myui,hg.repository(myui,url)
 
+class AuthorMap(object):
+  """Author map of exact 'From=To' rules and 're:Pattern=To' rules,
+  tried in order after the exact ones. A pattern has to match the whole
+  user string and To may refer to its groups as \\1, \\2 etc. The map
+  remembers the normalized form of the user strings it has seen."""
+
+  def __init__(self):
+    self.exact={}
+    self.patterns=[]
+    self.cache=OrderedDict()
+    self.digest=sha1()
+
+  def add(self,user,to):
+    self.digest.update(('%s=%s\n' % (user,to)).encode('utf-8'))
+    if user.startswith('re:'):
+      self.patterns.append((re.compile('(?:%s)$' % user[3:]),to))
+    else:
+      self.exact[user]=to
+
+  def __len__(self):
+    return len(self.exact)+len(self.patterns)
+
+  def get(self,user,default=None):
+    to=self.exact.get(user)
+    if to!=None:
+      return to
+    for p,to in self.patterns:
+      m=p.match(user)
+      if m!=None:
+        return m.expand(to)
+    return default
+
+  def normalize(self,user):
+    """Return fixup_user(user,self), computing it only once"""
+    r=self.cache.get(user)
+    if r==None:
+      r=clean_user(user,self)
+      if len(self.cache)>=cfg_user_cache:
+        self.cache.popitem(last=False)
+      self.cache[user]=r
+    return r
+
+  def load_cache(self,filename):
+    """Reuse the normalized users of an earlier run with the same rules"""
+    if not os.path.exists(filename):
+      return
+    f=open(filename,'r')
+    if f.readline()=='# %s\n' % self.digest.hexdigest():
+      for line in f:
+        fields=line.rstrip('\n').split('\t')
+        if len(fields)==2:
+          self.cache[fields[0]]=fields[1]
+    f.close()
+
+  def save_cache(self,filename):
+    save_text(filename,['# %s\n' % self.digest.hexdigest()]+
+        ['%s\t%s\n' % (u,r) for u,r in self.cache.items() if '\t' not in u])
+
+# used when no author map is given
+no_authors=AuthorMap()
+
+def load_authors(filename):
+  authors=AuthorMap()
+  if not os.path.exists(filename):
+    return authors
+  f=open(filename,'r')
+  l=0
+  for line in f.readlines():
+    l+=1
+    m=author_line_re.match(line)
+    if m==None:
+      sys.stderr.write('Invalid file format in [%s], line %d\n' % (filename,l))
+      continue
+    # put key:value in cache, key without ^:
+    authors.add(m.group(1).strip(),m.group(2).strip())
+  f.close()
+  sys.stderr.write('Loaded %d authors\n' % l)
+  return authors
+
+def join_path(dir,path):
+  return '/'.join([p for p in (dir.strip('/'),path) if p])
+
+class PathMap(object):
+  """Rules relocating, rewriting and dropping file paths. They are
+  applied in order, each to the path the ones before it produced:
+
+    move:From=To   move directory From (the root if empty) to To
+    re:Pattern=To  replace the matches of regular expression Pattern
+                   by To, which may refer to its groups as \\1, \\2 etc.
+    drop:Pattern   drop paths regular expression Pattern matches"""
+
+  def __init__(self):
+    self.rules=[]
+    # path -> mapped path or None
+    self.cache={}
+
+  def add(self,kind,pattern,to=None):
+    if kind=='re' or kind=='drop':
+      pattern=re.compile(pattern)
+    elif pattern.endswith('/'):
+      pattern=pattern[:-1]
+    self.rules.append((kind,pattern,to))
+
+  def __len__(self):
+    return len(self.rules)
+
+  def rewrite(self,path):
+    for kind,pattern,to in self.rules:
+      if kind=='drop':
+        if pattern.search(path)!=None:
+          return None
+      elif kind=='re':
+        path=pattern.sub(to,path)
+      elif pattern=='':
+        path=join_path(to,path)
+      elif path==pattern or path.startswith(pattern+'/'):
+        path=join_path(to,path[len(pattern)+1:])
+    return path
+
+  def map(self,path):
+    """Return the git path of hg file path, None if it is dropped"""
+    try:
+      return self.cache[path]
+    except KeyError:
+      r=self.cache[path]=self.rewrite(path)
+      return r
+
+# used when no path rules are given
+no_paths=PathMap()
+
+def load_path_rules(filename):
+  paths=PathMap()
+  f=open(filename,'r')
+  l=0
+  for line in f.readlines():
+    l+=1
+    line=line.rstrip('\n')
+    if line.strip()=='' or line.startswith('#'):
+      continue
+    m=path_rule_re.match(line)
+    if m==None:
+      sys.stderr.write('Invalid file format in [%s], line %d\n' % (filename,l))
+      continue
+    if m.group(4)!=None:
+      paths.add(m.group(4),m.group(5))
+    else:
+      paths.add(m.group(1),m.group(2),m.group(3))
+  f.close()
+  sys.stderr.write('Loaded %d path rules\n' % len(paths))
+  return paths
+
 def fixup_user(user,authors):
+  if authors==None:
+    authors=no_authors
+  if isinstance(authors,AuthorMap):
+    return authors.normalize(user)
+  return clean_user(user,authors)
+
+def clean_user(user,authors):
   user=user.strip("\"")
   if authors!=None:
     # if we have an authors table, try to get mapping
@@ -68,13 +251,138 @@ def get_branch(name):
     return origin_name + '/' + name
   return name
 
-def get_changeset(ui,repo,revision,authors={}):
+def get_tag(name):
+  if tag_namespace:
+    return tag_namespace + '/' + name
+  return name
+
+def sanitize_name(name,what="branch"):
+  """Sanitize input roughly according to git-check-ref-format(1)"""
+
+  n=sanitized.get((what,name))
+  if n!=None:
+    return n
+
+  def dot(name):
+    if name[0] == '.': return '_'+name[1:]
+    return name
+
+  n=ref_bad_re.sub('_', name)
+  if n[-1] in ('/', '.'): n=n[:-1]+'_'
+  n='/'.join(map(dot,n.split('/')))
+  n=ref_underscores_re.sub('_', n)
+
+  if n!=name:
+    sys.stderr.write('Warning: sanitized %s [%s] to [%s]\n' % (what,name,n))
+  sanitized[(what,name)]=n
+  return n
+
+def get_changeset(ui,repo,revision,authors=None):
   node=repo.lookup(revision)
   (manifest,user,(time,timezone),files,desc,extra)=repo.changelog.read(node)
   tz="%+03d%02d" % (-timezone / 3600, ((-timezone % 3600) / 60))
   branch=get_branch(extra.get('branch','master'))
   return (node,manifest,fixup_user(user,authors),(time,tz),files,desc,branch,extra)
 
+def file_size(repo,file,fnode):
+  """Return the size of a file revision, plus that of its copy metadata
+  if any. Unlike filectx.size() this never reads the contents."""
+  fl=repo.file(file)
+  rev=fl.rev(fnode)
+  if fl.index[rev][2]>=0:
+    return fl.index[rev][2]
+  return fl.size(rev)
+
+class FileStream(object):
+  """Contents of a file revision stored as a full text (not a delta),
+  read straight from the revlog in pieces of at most cfg_chunk_size
+  bytes, so memory does not grow with the file size. Iterating checks
+  the node hash at the end like revlog.revision() does."""
+
+  def __init__(self,fl,rev):
+    self.fl=fl
+    self.rev=rev
+    self.offset=fl.start(rev)
+    if fl._inline:
+      self.offset+=(rev+1)*fl._io.size
+    self.length=fl.length(rev)
+    # skip copy metadata, i.e. '\1\n...\1\n' in front of the contents
+    self.meta=0
+    head=''
+    for piece in self.raw(False):
+      head+=piece
+      if len(head)>=2 and not head.startswith('\1\n'):
+        break
+      if head.find('\1\n',2)>=0:
+        self.meta=head.index('\1\n',2)+2
+        break
+    self.size=fl.index[rev][2]-self.meta
+
+  def raw(self,check=True):
+    """Yield the stored text, metadata included"""
+    node=self.fl.node(self.rev)
+    p1,p2=self.fl.parents(node)
+    if p2==revlog.nullid:
+      h=sha1(revlog.nullid)
+      h.update(p1)
+    else:
+      h=sha1(min(p1,p2))
+      h.update(max(p1,p2))
+    f=self.fl.opener(self.fl._inline and self.fl.indexfile or self.fl.datafile)
+    try:
+      f.seek(self.offset)
+      left=self.length
+      kind=None
+      z=zlib.decompressobj()
+      while left>0:
+        buf=f.read(min(left,cfg_chunk_size))
+        if not buf:
+          raise revlog.RevlogError('%s: truncated revlog' % self.fl.indexfile)
+        left-=len(buf)
+        if kind==None:
+          kind=buf[0]
+          if kind=='u':
+            buf=buf[1:]
+          elif kind not in 'x\0':
+            raise revlog.RevlogError('unknown compression type %r' % kind)
+        if kind!='x':
+          h.update(buf)
+          yield buf
+          continue
+        while buf:
+          piece=z.decompress(buf,cfg_chunk_size)
+          buf=z.unconsumed_tail
+          h.update(piece)
+          yield piece
+      if kind=='x':
+        piece=z.flush()
+        h.update(piece)
+        yield piece
+    finally:
+      f.close()
+    if check and h.digest()!=node:
+      raise revlog.RevlogError('integrity check failed on %s:%d' % (self.fl.indexfile,self.rev))
+
+  def __iter__(self):
+    skip=self.meta
+    for piece in self.raw():
+      if skip>0:
+        n=min(skip,len(piece))
+        piece=piece[n:]
+        skip-=n
+      if piece:
+        yield piece
+
+def file_stream(repo,file,fnode):
+  """Return a FileStream of a file revision or None if it is stored as
+  a delta and has to be read with filectx.data()"""
+  fl=repo.file(file)
+  rev=fl.rev(fnode)
+  e=fl.index[rev]
+  if e[3]!=rev or e[2]<0 or fl.flags(rev):
+    return None
+  return FileStream(fl,rev)
+
 def mangle_key(key):
   return key
 
@@ -96,19 +404,28 @@ def load_cache(filename,get_key=mangle_key):
   return cache
 
 def save_cache(filename,cache):
-  f=open(filename,'w+')
-  map(lambda x: f.write(':%s %s\n' % (str(x),str(cache.get(x)))),cache.keys())
-  f.close()
+  save_text(filename,[':%s %s\n' % (str(x),str(cache.get(x))) for x in cache.keys()])
 
-def get_git_sha1(name,type='heads'):
+def load_git_refs():
+  """Resolve all refs of the git repository with one git-for-each-ref"""
+  refs={}
   try:
-    # use git-rev-parse to support packed refs
-    cmd="git rev-parse --verify refs/%s/%s 2>%s" % (type,name,os.devnull)
-    p=os.popen(cmd)
-    l=p.readline()
+    p=os.popen("git for-each-ref --format='%%(objectname) %%(refname)' 2>%s" % os.devnull)
+    for line in p:
+      sha1,name=line.rstrip('\n').split(' ',1)
+      refs[name]=sha1
     p.close()
-    if l == None or len(l) == 0:
-      return None
-    return l[0:40]
   except IOError:
-    return None
+    pass
+  return refs
+
+def reset_git_refs():
+  """Forget the refs snapshot so the next lookup reads them again"""
+  global git_refs
+  git_refs=None
+
+def get_git_sha1(name,type='heads'):
+  global git_refs
+  if git_refs==None:
+    git_refs=load_git_refs()
+  return git_refs.get('refs/%s/%s' % (type,name))
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Binary caches of hg-fast-export.
+
+A RevTable file is a 24 byte header (magic, record width, number of
+committed records) followed by fixed-width records, record i belonging
+to revision (or mark, or entry) i. An all-zero record is a hole.
+Committed records are read through mmap. New records are appended
+behind them and only become visible once the count in the header has
+been rewritten, so an interrupted run leaves the old table intact;
+changes to committed records rewrite a copy which is renamed into
+place."""
+
+from binascii import hexlify,unhexlify
+import mmap
+import os
+import struct
+import sys
+
+magic=b'HG2GITRT'
+header=struct.Struct('<8sIIQ')
+version=1
+# first mark handed out to blobs; commits own marks 1..tip
+cfg_blob_mark_base=1<<30
+
+def replace(src,dst):
+  """Atomically move src over dst"""
+  try:
+    os.replace(src,dst)
+  except AttributeError:
+    # Python 2
+    os.rename(src,dst)
+
+def is_text(filename):
+  """See if filename is a cache in the old ':key value' text format"""
+  if not os.path.exists(filename):
+    return False
+  f=open(filename,'rb')
+  c=f.read(1)
+  f.close()
+  return c==b':'
+
+def read_text(filename):
+  """Parse a ':key value' text file into a list of (key,value)"""
+  l=[]
+  f=open(filename,'r')
+  n=0
+  for line in f:
+    n+=1
+    fields=line.split(' ')
+    if len(fields)!=2 or fields[0][0]!=':':
+      sys.stderr.write('Invalid file format in [%s], line %d\n' % (filename,n))
+      continue
+    l.append((fields[0][1:],fields[1].split('\n')[0]))
+  f.close()
+  return l
+
+class RevTable(object):
+  """A persistent array of fixed-width records"""
+
+  def __init__(self,filename,width):
+    self.filename=filename
+    self.width=width
+    self.map=None
+    self.open()
+
+  def open(self):
+    self.count=0
+    self.pending=bytearray()
+    self.changes={}
+    self.rewrite=False
+    if self.map!=None:
+      self.map.close()
+      self.map=None
+    if (not os.path.exists(self.filename) or os.path.getsize(self.filename)==0
+        or is_text(self.filename)):
+      # a new, touched or old style file is replaced as a whole on commit
+      self.rewrite=True
+      return
+    f=open(self.filename,'rb')
+    try:
+      m,v,width,count=header.unpack(f.read(header.size))
+      if m!=magic or v!=version or width!=self.width:
+        raise ValueError('%s is not a table of %d byte records' % (self.filename,self.width))
+      if count:
+        self.map=mmap.mmap(f.fileno(),header.size+count*width,access=mmap.ACCESS_READ)
+      self.count=count
+    finally:
+      f.close()
+
+  def close(self):
+    if self.map!=None:
+      self.map.close()
+      self.map=None
+
+  def __len__(self):
+    return self.count+len(self.pending)//self.width
+
+  def get(self,i):
+    """Return record i, None if it is a hole or beyond the end"""
+    if i<0 or i>=len(self):
+      return None
+    r=self.changes.get(i)
+    if r==None:
+      if i<self.count:
+        o=header.size+i*self.width
+        r=self.map[o:o+self.width]
+      else:
+        o=(i-self.count)*self.width
+        r=bytes(self.pending[o:o+self.width])
+    if r==b'\0'*self.width:
+      return None
+    return r
+
+  __getitem__=get
+
+  def __setitem__(self,i,value):
+    if len(value)!=self.width:
+      raise ValueError('record of %d bytes instead of %d' % (len(value),self.width))
+    n=len(self)
+    if i>=n:
+      # fill any gap with holes
+      self.pending+=b'\0'*((i-n)*self.width)
+      self.pending+=value
+    elif i>=self.count:
+      o=(i-self.count)*self.width
+      self.pending[o:o+self.width]=value
+    else:
+      self.changes[i]=value
+      self.rewrite=True
+
+  def append(self,value):
+    self[len(self)]=value
+
+  def truncate(self,n):
+    """Drop all records from n on"""
+    if n>=len(self):
+      return
+    if n>=self.count:
+      del self.pending[(n-self.count)*self.width:]
+      return
+    for i in list(self.changes.keys()):
+      if i>=n: del self.changes[i]
+    self.pending=bytearray()
+    self.count=n
+    self.rewrite=True
+
+  def find(self,value):
+    """Return the index of the first record equal to value or -1"""
+    for i,r in self.changes.items():
+      if r==value: return i
+    if self.map!=None:
+      o=self.map.find(value,header.size,header.size+self.count*self.width)
+      while o>=0:
+        if (o-header.size)%self.width==0 and (o-header.size)//self.width not in self.changes:
+          return (o-header.size)//self.width
+        o=self.map.find(value,o+1,header.size+self.count*self.width)
+    o=self.pending.find(value)
+    while o>=0:
+      if o%self.width==0:
+        return self.count+o//self.width
+      o=self.pending.find(value,o+1)
+    return -1
+
+  def raw(self,n=None):
+    """Return the first n (default all) records as one byte string,
+    holes as zeros"""
+    if n==None or n>len(self):
+      n=len(self)
+    if self.changes:
+      return b''.join([self.get(i) or b'\0'*self.width for i in range(n)])
+    r=b''
+    if self.map!=None:
+      r=self.map[header.size:header.size+min(n,self.count)*self.width]
+    if n>self.count:
+      r+=bytes(self.pending[:(n-self.count)*self.width])
+    return r
+
+  def records(self):
+    """Iterate over (index,record) of all records but holes"""
+    for i in range(len(self)):
+      r=self.get(i)
+      if r!=None: yield i,r
+
+  def commit(self):
+    """Make all changes durable"""
+    n=len(self)
+    if self.rewrite:
+      tmp=self.filename+'.new'
+      f=open(tmp,'wb')
+      f.write(header.pack(magic,version,self.width,n))
+      for i in range(n):
+        f.write(self.get(i) or b'\0'*self.width)
+      f.flush()
+      os.fsync(f.fileno())
+      f.close()
+      self.close()
+      replace(tmp,self.filename)
+    elif self.pending:
+      f=open(self.filename,'r+b')
+      f.seek(header.size+self.count*self.width)
+      f.write(self.pending)
+      f.flush()
+      os.fsync(f.fileno())
+      # only now the new records become part of the table
+      f.seek(0)
+      f.write(header.pack(magic,version,self.width,n))
+      f.flush()
+      os.fsync(f.fileno())
+      f.close()
+    else:
+      return
+    self.open()
+
+# record of the aliases table: the mark a pruned revision's mark stands for
+alias=struct.Struct('<I')
+# alias of a revision pruned without any ancestor left to stand for it
+no_commit=0xffffffff
+
+class Marks(object):
+  """git SHA1s of the marks git-fast-import exported. Commit marks
+  1..n are stored by revision in filename, blob marks from blob_base on
+  in filename-blobs. The commits of pruned revisions were never
+  exported; filename-aliases has the commit mark each of them stands
+  for instead. Converts a marks file in the old text format."""
+
+  def __init__(self,filename,blob_base=cfg_blob_mark_base):
+    self.blob_base=blob_base
+    legacy=None
+    if is_text(filename):
+      legacy=read_text(filename)
+    self.commits=RevTable(filename,20)
+    self.blobs=RevTable(filename+'-blobs',20)
+    self.aliases=RevTable(filename+'-aliases',alias.size)
+    if legacy!=None:
+      for mark,sha1 in legacy:
+        self.set(int(mark),sha1)
+      self.commit()
+
+  def table(self,mark):
+    if mark>=self.blob_base:
+      return self.blobs,mark-self.blob_base
+    return self.commits,mark-1
+
+  def resolve(self,mark):
+    """Return the mark of the commit standing for commit mark, 0 if
+    there is none"""
+    if mark>=self.blob_base:
+      return mark
+    while True:
+      r=self.aliases.get(mark-1)
+      if r==None:
+        return mark
+      mark=alias.unpack(r)[0]
+      if mark==no_commit:
+        return 0
+
+  def alias(self,mark,target):
+    """Let commit mark stand for commit mark target (0 for none)"""
+    self.aliases[mark-1]=alias.pack(target or no_commit)
+
+  def unalias(self,mark):
+    """Let commit mark stand for itself again"""
+    if self.aliases.get(mark-1)!=None:
+      self.aliases[mark-1]=b'\0'*alias.size
+
+  def exported(self,mark):
+    """See if mark, or the mark it stands for, was exported"""
+    mark=self.resolve(mark)
+    return mark==0 or self.get(mark)!=None
+
+  def get(self,mark):
+    """Return the hex SHA1 of mark (or the mark it stands for), None if
+    it was never exported"""
+    mark=self.resolve(mark)
+    if mark==0:
+      return None
+    t,i=self.table(mark)
+    r=t.get(i)
+    if r==None:
+      return None
+    return hexlify(r).decode('ascii')
+
+  def set(self,mark,sha1):
+    t,i=self.table(mark)
+    t[i]=unhexlify(sha1)
+
+  def next_blob(self):
+    """Return the first blob mark never exported"""
+    return self.blob_base+len(self.blobs)
+
+  def import_text(self,filename,offset=0):
+    """Add the marks of a git-fast-import --export-marks file. With an
+    offset, only those of marks offset+1..offset+(1<<32)-1, less offset"""
+    if not os.path.exists(filename):
+      return
+    for mark,sha1 in read_text(filename):
+      mark=int(mark)-offset
+      if mark>0 and mark<1<<32:
+        self.set(mark,sha1)
+
+  def truncate(self,rev):
+    """Forget the commit marks of revisions rev and later"""
+    self.commits.truncate(rev)
+    self.aliases.truncate(rev)
+
+  def commits_from(self,rev):
+    """Return the hex SHA1s of the commits of revisions rev and later"""
+    return [hexlify(r).decode('ascii') for i,r in self.commits.records() if i>=rev]
+
+  def forget_blobs(self,sha1s):
+    """Forget the blob marks of the hex SHA1s in sha1s, so that their
+    blobs are exported again"""
+    for i,r in list(self.blobs.records()):
+      if hexlify(r).decode('ascii') in sha1s:
+        self.blobs[i]=b'\0'*self.blobs.width
+
+  def commit(self):
+    # the commit table replaces an old text file, so write it last
+    self.blobs.commit()
+    self.aliases.commit()
+    self.commits.commit()
+
+  def text(self):
+    """Yield the marks as git-fast-import --import-marks lines"""
+    for t,base in ((self.commits,1),(self.blobs,self.blob_base)):
+      for i,r in t.records():
+        yield ':%d %s\n' % (base+i,hexlify(r).decode('ascii'))
+
+def open_mapping(filename):
+  """Open the table of hg changeset nodes by revision, converting a
+  ':hexnode rev' text file"""
+  legacy=None
+  if is_text(filename):
+    legacy=read_text(filename)
+  t=RevTable(filename,20)
+  if legacy!=None:
+    for hexnode,rev in legacy:
+      t[int(rev)]=unhexlify(hexnode)
+    t.commit()
+  return t
+
+class BlobKeys(object):
+  """Dict of blob keys (a kind byte and a 20 byte hash) to blob marks,
+  stored as a log of (key,mark offset) records where later records win.
+  Converts a ':key mark' text file."""
+
+  record=struct.Struct('<21sI')
+
+  def __init__(self,filename,blob_base=cfg_blob_mark_base):
+    self.blob_base=blob_base
+    legacy=None
+    if is_text(filename):
+      legacy=read_text(filename)
+    self.log=RevTable(filename,self.record.size)
+    self.keys={}
+    # one past the highest mark ever recorded, exported or not
+    self.end=blob_base
+    for _,r in self.log.records():
+      key,offset=self.record.unpack(r)
+      self.keys[key]=offset+blob_base
+      self.end=max(self.end,offset+blob_base+1)
+    if legacy!=None:
+      for key,mark in legacy:
+        if key.startswith('sha1:'):
+          self[b'c'+unhexlify(key[5:])]=int(mark)
+        else:
+          self[b'f'+unhexlify(key)]=int(mark)
+      self.log.commit()
+
+  def __len__(self):
+    return len(self.keys)
+
+  def get(self,key,default=None):
+    return self.keys.get(key,default)
+
+  def __contains__(self,key):
+    return key in self.keys
+
+  def __getitem__(self,key):
+    return self.keys[key]
+
+  def __setitem__(self,key,mark):
+    if self.keys.get(key)==mark:
+      return
+    self.keys[key]=mark
+    self.end=max(self.end,mark+1)
+    self.log.append(self.record.pack(key,mark-self.blob_base))
+
+  def __delitem__(self,key):
+    # only forgotten in memory, see drop()
+    del self.keys[key]
+
+  def drop(self,keep):
+    """Forget all keys whose mark does not satisfy keep(mark)"""
+    for key,mark in list(self.keys.items()):
+      if not keep(mark): del self.keys[key]
+
+  def commit(self):
+    self.log.commit()
+
+def save_text(filename,lines):
+  """Atomically replace filename by lines"""
+  tmp=filename+'.new'
+  f=open(tmp,'w')
+  f.writelines(lines)
+  f.flush()
+  os.fsync(f.fileno())
+  f.close()
+  replace(tmp,filename)
+
+if __name__=='__main__':
+  from optparse import OptionParser
+
+  usage="""%prog import-marks MARKS GFI-MARKS [OFFSET]
+       %prog export-marks MARKS
+       %prog export-mapping MAPPING
+
+import-marks  add git-fast-import's exported marks to MARKS, those
+              of OFFSET+1 on less OFFSET if given
+export-marks  print MARKS in git-fast-import's format
+export-mapping  print MAPPING in the old ':hexnode rev' format"""
+  parser=OptionParser(usage=usage)
+  (options,args)=parser.parse_args()
+
+  if len(args) in (3,4) and args[0]=='import-marks':
+    marks=Marks(args[1])
+    marks.import_text(args[2],len(args)==4 and int(args[3]) or 0)
+    marks.commit()
+  elif len(args)==2 and args[0]=='export-marks':
+    sys.stdout.writelines(Marks(args[1]).text())
+  elif len(args)==2 and args[0]=='export-mapping':
+    for rev,n in open_mapping(args[1]).records():
+      sys.stdout.write(':%s %d\n' % (hexlify(n).decode('ascii'),rev))
+  else:
+    parser.print_help()
+    sys.exit(2)
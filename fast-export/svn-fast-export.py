@@ -16,26 +16,132 @@ first_rev = 1
 final_rev = 0
 
 import sys, os.path
+from binascii import unhexlify
 from optparse import OptionParser
 from time import mktime, strptime
 from svn.fs import svn_fs_file_length, svn_fs_file_contents, svn_fs_is_dir, svn_fs_revision_root, svn_fs_youngest_rev, svn_fs_revision_proplist, svn_fs_paths_changed
+from svn.fs import svn_fs_copied_from, svn_fs_dir_entries
 from svn.core import svn_pool_create, svn_pool_clear, svn_pool_destroy, svn_stream_for_stdout, svn_stream_copy, svn_stream_close, run_app
+from svn.core import svn_node_dir
 from svn.repos import svn_repos_open, svn_repos_fs
+from telemetry import Telemetry
+from revstore import BlobKeys, cfg_blob_mark_base, read_text, save_text
+try:
+    from svn.fs import svn_fs_file_checksum
+    from svn.core import svn_checksum_sha1, svn_checksum_to_cstring_display
+except ImportError:
+    # Subversion before 1.6
+    svn_fs_file_checksum = None
+    from svn.fs import svn_fs_file_md5_checksum
 
 ct_short = ['M', 'A', 'D', 'R', 'X']
 
+# time spent per phase, written with --stats
+stats = Telemetry()
+
+# content key -> blob mark, kept in the --marks file if given. Commit
+# marks count up from 1, blob marks from cfg_blob_mark_base, across
+# revisions and runs.
+blob_marks = {}
+next_blob_mark = cfg_blob_mark_base
+next_commit_mark = 1
+
+# directory keeping what earlier runs exported, see load_state()
+state_dir = None
+# ref -> mark of its last commit
+heads = {}
+# (mark, revision, ref) of every commit so far, and of every ref
+# copied from another one without changes
+committed = []
+
+def content_key(root, path, pool):
+    """Return a key naming the contents of path, from the checksum
+    Subversion keeps anyway"""
+    if svn_fs_file_checksum != None:
+        checksum = svn_fs_file_checksum(svn_checksum_sha1, root, path, True, pool)
+        return 's' + unhexlify(svn_checksum_to_cstring_display(checksum, pool))
+    digest = svn_fs_file_md5_checksum(root, path, pool)
+    if len(digest) == 32:
+        digest = unhexlify(digest)
+    return 'm' + digest
+
+def blob_mark(root, path, pool):
+    """Return the mark of the blob holding the contents of path,
+    sending the contents first unless some earlier blob has them"""
+    global next_blob_mark
+
+    with stats.phase('manifest'):
+        key = content_key(root, path, pool)
+    mark = blob_marks.get(key)
+    if mark == None:
+        mark = next_blob_mark
+        next_blob_mark += 1
+        write("blob\nmark :%s\n" % mark)
+        dump_file_blob(root, path, pool)
+        blob_marks[key] = mark
+    return mark
+
+def write(s):
+    stats.count('bytes', len(s))
+    with stats.phase('write'):
+        sys.stdout.write(s)
+
 def dump_file_blob(root, full_path, pool):
     stream_length = svn_fs_file_length(root, full_path, pool)
     stream = svn_fs_file_contents(root, full_path, pool)
-    sys.stdout.write("data %s\n" % stream_length)
-    sys.stdout.flush()
-    ostream = svn_stream_for_stdout(pool)
-    svn_stream_copy(stream, ostream, pool)
-    svn_stream_close(ostream)
-    sys.stdout.write("\n")
+    write("data %s\n" % stream_length)
+    with stats.phase('write'):
+        sys.stdout.flush()
+    # reading and writing the contents cannot be told apart
+    stats.count('bytes', stream_length)
+    with stats.phase('filedata'):
+        ostream = svn_stream_for_stdout(pool)
+        svn_stream_copy(stream, ostream, pool)
+        svn_stream_close(ostream)
+    write("\n")
+
+
+def split_path(path):
+    """Return the ref path belongs to and its path relative to the
+    root of that ref, or None if it is outside trunk, branches and tags"""
+    if path + '/' == trunk_path or path.startswith(trunk_path):
+        return 'refs/heads/master', path[len(trunk_path):]
+    for prefix, refs in ((branches_path, 'refs/heads/'), (tags_path, 'refs/tags/')):
+        if path.startswith(prefix):
+            rest = path[len(prefix):].split('/', 1)
+            if rest[0] == '':
+                return None
+            if len(rest) == 1:
+                return refs + rest[0], ''
+            return refs + rest[0], rest[1]
+    return None
+
+def walk_files(root, path, pool):
+    """Yield the paths of all files below directory path"""
+    entries = svn_fs_dir_entries(root, path, pool)
+    for name in sorted(entries.keys()):
+        p = path + '/' + name
+        if entries[name].kind == svn_node_dir:
+            for f in walk_files(root, p, pool):
+                yield f
+        else:
+            yield p
 
+def mark_at(ref, rev):
+    """Return the mark of ref as of revision rev, None if it did not
+    exist then"""
+    for mark, r, branch in reversed(committed):
+        if branch == ref and r <= rev:
+            return mark
+    return None
+
+def record(mark, rev, ref):
+    heads[ref] = mark
+    committed.append((mark, rev, ref))
 
 def export_revision(rev, repo, fs, pool):
+    global next_commit_mark
+
     sys.stderr.write("Exporting revision %s... " % rev)
 
     revpool = svn_pool_create(pool)
@@ -45,32 +151,65 @@ def export_revision(rev, repo, fs, pool):
     root = svn_fs_revision_root(fs, rev, revpool)
 
     # And the list of what changed in this revision.
-    changes = svn_fs_paths_changed(root, revpool)
+    with stats.phase('changelog'):
+        changes = svn_fs_paths_changed(root, revpool)
 
-    i = 1
-    marks = {}
-    file_changes = []
+    # ref -> file changes
+    file_changes = {}
+    # ref -> mark of the commit a copied branch or tag starts from
+    starts = {}
 
-    for path, change_type in changes.iteritems():
+    # sorted, so a copied directory comes before changes inside it
+    for path, change_type in sorted(changes.items()):
         c_t = ct_short[change_type.change_kind]
-        if svn_fs_is_dir(root, path, revpool):
+        where = split_path(path)
+        if where == None:
             continue
+        ref, rel = where
+        lines = file_changes.setdefault(ref, [])
 
-        if not path.startswith(trunk_path):
-            # We don't handle branches. Or tags. Yet.
-            pass
-        else:
-            if c_t == 'D':
-                file_changes.append("D %s" % path.replace(trunk_path, ''))
+        if c_t == 'D':
+            if rel == '':
+                sys.stderr.write("%s deleted in svn, keeping it... " % ref)
             else:
-                marks[i] = path.replace(trunk_path, '')
-                file_changes.append("M 644 :%s %s" % (i, marks[i]))
-                sys.stdout.write("blob\nmark :%s\n" % i)
-                dump_file_blob(root, path, revpool)
-                i += 1
+                lines.append("D %s" % rel)
+            continue
+
+        with stats.phase('manifest'):
+            is_dir = svn_fs_is_dir(root, path, revpool)
+        if not is_dir:
+            mark = blob_mark(root, path, revpool)
+            lines.append("M 644 :%s %s" % (mark, rel))
+            continue
+        if c_t not in ('A', 'R'):
+            continue
+
+        with stats.phase('changelog'):
+            from_rev, from_path = svn_fs_copied_from(root, path, revpool)
+        if from_path == None:
+            # new directories only show up with files in them
+            continue
+        source = split_path(from_path)
+        if rel == '' and source != None and source[1] == '':
+            # a branch or tag copied as a whole: point the ref to the
+            # commit of the source instead of sending its tree again
+            mark = mark_at(source[0], from_rev)
+            if mark != None:
+                starts[ref] = mark
+                continue
+        # copied from anywhere else: add the files one by one, whose
+        # contents are sent at most once anyway
+        if rel == '':
+            lines.append("deleteall")
+        elif c_t == 'R':
+            lines.append("D %s" % rel)
+        for f in walk_files(root, path, revpool):
+            mark = blob_mark(root, f, revpool)
+            lines.append("M 644 :%s %s" % (mark, (rel and rel + '/') + f[len(path) + 1:]))
 
     # Get the commit author and message
-    props = svn_fs_revision_proplist(fs, rev, revpool)
+    with stats.phase('changelog'):
+        props = svn_fs_revision_proplist(fs, rev, revpool)
 
     # Do the recursive crawl.
     if props.has_key('svn:author'):
@@ -78,20 +217,34 @@ def export_revision(rev, repo, fs, pool):
     else:
         author = 'nobody <nobody@localhost>'
 
-    if len(file_changes) == 0:
+    refs = [ref for ref in file_changes if file_changes[ref]] + starts.keys()
+    if len(refs) == 0:
         svn_pool_destroy(revpool)
         sys.stderr.write("skipping.\n")
         return
 
     svndate = props['svn:date'][0:-8]
     commit_time = mktime(strptime(svndate, '%Y-%m-%dT%H:%M:%S'))
-    sys.stdout.write("commit refs/heads/master\n")
-    sys.stdout.write("committer %s %s -0000\n" % (author, int(commit_time)))
-    sys.stdout.write("data %s\n" % len(props['svn:log']))
-    sys.stdout.write(props['svn:log'])
-    sys.stdout.write("\n")
-    sys.stdout.write('\n'.join(file_changes))
-    sys.stdout.write("\n\n")
+    for ref in sorted(set(refs)):
+        lines = file_changes.get(ref)
+        parent = starts.get(ref, heads.get(ref))
+        if not lines:
+            # copied without changes: no new commit needed
+            write("reset %s\nfrom :%s\n\n" % (ref, parent))
+            record(parent, rev, ref)
+            continue
+        write("commit %s\n" % ref)
+        write("mark :%s\n" % next_commit_mark)
+        write("committer %s %s -0000\n" % (author, int(commit_time)))
+        write("data %s\n" % len(props['svn:log']))
+        write(props['svn:log'])
+        write("\n")
+        if parent != None:
+            write("from :%s\n" % parent)
+        write('\n'.join(lines))
+        write("\n\n")
+        record(next_commit_mark, rev, ref)
+        next_commit_mark += 1
 
     svn_pool_destroy(revpool)
 
@@ -102,6 +255,54 @@ def export_revision(rev, repo, fs, pool):
     #    sleep(5)
 
 
+def load_state(path):
+    """Continue after the last revision an earlier run exported to
+    the state directory PATH. It holds
+
+      state   the last revision exported (':tip N')
+      commits mark, revision and ref of every commit (':mark rev ref')
+      blobs   the blob marks of content checksums
+      marks   git-fast-import's --export-marks file
+
+    Commits git-fast-import has no mark for, because it failed, and all
+    revisions after the first of them are exported again."""
+    global first_rev, blob_marks, next_blob_mark, next_commit_mark
+
+    def read(name):
+        f = os.path.join(path, name)
+        if not os.path.exists(f):
+            return []
+        return read_text(f)
+
+    marks = set([int(mark) for mark, sha1 in read('marks')])
+    tip = int(dict(read('state')).get('tip', 0))
+    log = []
+    f = os.path.join(path, 'commits')
+    if os.path.exists(f):
+        for line in open(f):
+            mark, rev, ref = line.split()
+            log.append((int(mark[1:]), int(rev), ref))
+    for mark, rev, ref in log:
+        if rev <= tip and mark not in marks:
+            sys.stderr.write("git-fast-import has no mark for r%d, exporting it again\n" % rev)
+            tip = min(tip, rev - 1)
+    for mark, rev, ref in log:
+        if rev <= tip:
+            record(mark, rev, ref)
+            next_commit_mark = max(next_commit_mark, mark + 1)
+
+    blob_marks = BlobKeys(os.path.join(path, 'blobs'))
+    blob_marks.drop(lambda mark: mark in marks)
+    next_blob_mark = blob_marks.end
+    first_rev = tip + 1
+
+def save_state(path, repos_path, tip):
+    save_text(os.path.join(path, 'commits'),
+              [":%d %d %s\n" % entry for entry in committed])
+    blob_marks.commit()
+    # the tip goes last, it declares the rest complete
+    save_text(os.path.join(path, 'state'), [":tip %d\n" % tip, ":repo %s\n" % repos_path])
+
 def crawl_revisions(pool, repos_path):
     """Open the repository at REPOS_PATH, and recursively crawl all its
     revisions."""
@@ -115,26 +316,47 @@ def crawl_revisions(pool, repos_path):
     # Query the current youngest revision.
     youngest_rev = svn_fs_youngest_rev(fs_obj, pool)
 
-
-    first_rev = 1
     if final_rev == 0:
         final_rev = youngest_rev
+    if first_rev > final_rev:
+        sys.stderr.write("Nothing to export after r%d\n" % final_rev)
     for rev in xrange(first_rev, final_rev + 1):
         export_revision(rev, repos_obj, fs_obj, pool)
+        stats.count('revisions')
+        stats.tick()
+    if state_dir != None:
+        save_state(state_dir, repos_path, max(final_rev, first_rev - 1))
+    elif isinstance(blob_marks, BlobKeys):
+        blob_marks.commit()
+    stats.close()
 
 
 if __name__ == '__main__':
     usage = '%prog [options] REPOS_PATH'
     parser = OptionParser()
     parser.set_usage(usage)
+    parser.add_option('--first-rev', help='First revision to import',
+                      dest='first_rev', metavar='FIRST_REV', type='int')
     parser.add_option('-f', '--final-rev', help='Final revision to import', 
                       dest='final_rev', metavar='FINAL_REV', type='int')
+    parser.add_option('-s', '--state', help='Directory to keep state in for incremental runs '
+                      '(pass git-fast-import --import-marks-if-exists and --export-marks of STATEDIR/marks)',
+                      dest='state_dir', metavar='STATEDIR')
     parser.add_option('-t', '--trunk-path', help='Path in repo to /trunk',
                       dest='trunk_path', metavar='TRUNK_PATH')
     parser.add_option('-b', '--branches-path', help='Path in repo to /branches',
                       dest='branches_path', metavar='BRANCHES_PATH')
     parser.add_option('-T', '--tags-path', help='Path in repo to /tags',
                       dest='tags_path', metavar='TAGS_PATH')
+    parser.add_option('-m', '--marks', help='File to keep the blob marks of content checksums in '
+                      '(git-fast-import must then keep its marks too, see --export-marks)',
+                      dest='marksfile', metavar='MARKSFILE')
+    parser.add_option('--stats', help='Append performance records as JSON lines to STATSFILE',
+                      dest='statsfile', metavar='STATSFILE')
+    parser.add_option('--stats-interval', help='Seconds between two performance records',
+                      dest='stats_interval', metavar='SECONDS', type='float')
+    parser.add_option('--profile', help='Dump a cProfile profile of each phase into PROFILEDIR',
+                      dest='profiledir', metavar='PROFILEDIR')
     (options, args) = parser.parse_args()
 
     if options.trunk_path != None:
@@ -143,6 +365,8 @@ if __name__ == '__main__':
         branches_path = options.branches_path
     if options.tags_path != None:
         tags_path = options.tags_path
+    if options.first_rev != None:
+        first_rev = options.first_rev
     if options.final_rev != None:
         final_rev = options.final_rev
 
@@ -150,6 +374,17 @@ if __name__ == '__main__':
         parser.print_help()
         sys.exit(2)
 
+    stats.open(options.statsfile, options.stats_interval, options.profiledir)
+
+    if options.state_dir != None:
+        state_dir = options.state_dir
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        load_state(state_dir)
+    elif options.marksfile != None:
+        blob_marks = BlobKeys(options.marksfile)
+        next_blob_mark = blob_marks.end
+
     # Canonicalize (enough for Subversion, at least) the repository path.
     repos_path = os.path.normpath(args[0])
     if repos_path == '.': 
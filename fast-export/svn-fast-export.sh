@@ -0,0 +1,60 @@
+#!/bin/sh
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+ROOT="`dirname $0`"
+REPO=""
+PFX="svn2git"
+GFI_OPTS=""
+PYTHON=${PYTHON:-python}
+
+USAGE="[--quiet] [-r <repo>] [svn-fast-export.py options]"
+LONG_USAGE="Import svn repository <repo> up to either its youngest revision
+or the one given with -f. Later runs only import new revisions.
+If <repo> is omitted, use last svn repository as obtained from state
+directory GIT_DIR/$PFX.
+
+Options:
+	--quiet	Passed to git-fast-import(1)
+	-r	Subversion repository to import
+	-f	Final revision to import
+"
+
+. "$(git --exec-path)/git-sh-setup"
+cd_to_toplevel
+
+while case "$#" in 0) break ;; esac
+do
+  case "$1" in
+    -r|--r|--re|--rep|--repo)
+      shift
+      REPO="$1"
+      ;;
+    --q|--qu|--qui|--quie|--quiet)
+      GFI_OPTS="$GFI_OPTS --quiet"
+      ;;
+    *)
+      # pass any other options down to svn-fast-export.py
+      break
+      ;;
+  esac
+  shift
+done
+
+STATE="$GIT_DIR/$PFX"
+mkdir -p "$STATE" || exit 1
+
+# for convenience: get default repo from state file
+if [ x"$REPO" = x -a -f "$STATE/state" ] ; then
+  REPO="`egrep '^:repo ' "$STATE/state" | cut -d ' ' -f 2`"
+  echo "Using last svn repository \"$REPO\""
+fi
+if [ x"$REPO" = x ] ; then
+  usage
+fi
+
+# git-fast-import keeps its marks in the state directory too, also
+# when it fails, so the next run knows which commits made it
+$PYTHON "$ROOT/svn-fast-export.py" --state "$STATE" "$@" "$REPO" \
+| git fast-import $GFI_OPTS --import-marks-if-exists="$STATE/marks" \
+  --export-marks="$STATE/marks"
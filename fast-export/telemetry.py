@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+# License: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+"""Performance telemetry of the exporters.
+
+Time is accounted to named phases like 'changelog', 'manifest',
+'filedata', 'write' or 'tags'. Phases nest; a phase is only charged
+for the time not spent in phases entered within it, so the phases of a
+record add up to at most its elapsed time. Every interval seconds a
+JSON object with the wall and CPU time per phase, the counters, their
+rates over the interval and the peak RSS is appended to the stats
+file as one line. Optionally every phase is run under its own cProfile
+profiler and dumped to PROFILEDIR/<phase>.prof at the end."""
+
+import json
+import os
+import sys
+import time
+
+try:
+  import resource
+except ImportError:
+  # not on Windows
+  resource=None
+
+# write a stats record at most every this many seconds
+cfg_stats_interval=10
+
+def cpu_time():
+  t=os.times()
+  return t[0]+t[1]
+
+def peak_rss():
+  """Return the peak resident set size in kB (of the largest waited
+  for child if that is larger), None if unknown"""
+  if resource==None:
+    return None
+  r=max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  if sys.platform=='darwin':
+    # bytes instead of kB
+    r//=1024
+  return r
+
+class NullPhase(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*args):
+    return False
+
+null_phase=NullPhase()
+
+class Phase(object):
+  def __init__(self,telemetry,name):
+    self.telemetry=telemetry
+    self.name=name
+
+  def __enter__(self):
+    self.telemetry.enter(self.name)
+    return self
+
+  def __exit__(self,*args):
+    self.telemetry.leave()
+    return False
+
+class Telemetry(object):
+  """Phase timer and counters; does nothing until open()ed"""
+
+  def __init__(self):
+    self.enabled=False
+    self.file=None
+    self.profiledir=None
+    self.interval=cfg_stats_interval
+    # name -> [wall,cpu,calls]
+    self.phases={}
+    self.profiles={}
+    self.stack=[]
+    self.counters={}
+    self.gauges={}
+
+  def open(self,filename=None,interval=None,profiledir=None):
+    if filename==None and profiledir==None:
+      return
+    if filename!=None:
+      self.file=open(filename,'a')
+    if interval!=None:
+      self.interval=interval
+    self.profiledir=profiledir
+    self.enabled=True
+    self.start=self.last=self.emitted=time.time()
+    self.start_cpu=self.last_cpu=cpu_time()
+    self.previous={}
+
+  def detach(self):
+    """Stop recording without writing anything, e.g. in a forked worker"""
+    self.enabled=False
+    self.file=None
+    self.profiledir=None
+
+  def phase(self,name):
+    """Return a context manager accounting its body to phase name"""
+    if not self.enabled:
+      return null_phase
+    return Phase(self,name)
+
+  def charge(self):
+    now,cpu=time.time(),cpu_time()
+    if self.stack:
+      p=self.phases[self.stack[-1]]
+      p[0]+=now-self.last
+      p[1]+=cpu-self.last_cpu
+    self.last,self.last_cpu=now,cpu
+
+  def profile(self,enable):
+    if self.profiledir==None or not self.stack:
+      return
+    name=self.stack[-1]
+    if enable:
+      p=self.profiles.get(name)
+      if p==None:
+        import cProfile
+        p=self.profiles[name]=cProfile.Profile()
+      p.enable()
+    else:
+      self.profiles[name].disable()
+
+  def enter(self,name):
+    self.charge()
+    self.profile(False)
+    p=self.phases.get(name)
+    if p==None:
+      p=self.phases[name]=[0.0,0.0,0]
+    p[2]+=1
+    self.stack.append(name)
+    self.profile(True)
+
+  def leave(self):
+    self.charge()
+    self.profile(False)
+    self.stack.pop()
+    self.profile(True)
+
+  def count(self,name,n=1):
+    self.counters[name]=self.counters.get(name,0)+n
+
+  def gauge(self,name,f):
+    """Report the value of f() as counter name"""
+    self.gauges[name]=f
+
+  def tick(self):
+    """Write a record if the last one is older than the interval"""
+    if self.file!=None and time.time()-self.emitted>=self.interval:
+      self.emit()
+
+  def emit(self,final=False):
+    self.charge()
+    now=time.time()
+    span=max(now-self.emitted,1e-6)
+    r={'time':round(now,3),'elapsed':round(now-self.start,3),
+       'cpu':round(cpu_time()-self.start_cpu,3),'peak_rss_kb':peak_rss()}
+    values=dict(self.counters)
+    for name,f in self.gauges.items():
+      values[name]=f()
+    for name,v in values.items():
+      r[name]=v
+      r[name+'_per_sec']=round((v-self.previous.get(name,0))/span,1)
+    r['phases']=dict([(name,{'wall':round(p[0],6),'cpu':round(p[1],6),'calls':p[2]})
+        for name,p in self.phases.items()])
+    if final:
+      r['final']=True
+    self.file.write(json.dumps(r,sort_keys=True)+'\n')
+    self.file.flush()
+    self.previous=values
+    self.emitted=now
+
+  def close(self):
+    if not self.enabled:
+      return
+    if self.file!=None:
+      self.emit(True)
+      self.file.close()
+    if self.profiledir!=None:
+      if not os.path.isdir(self.profiledir):
+        os.makedirs(self.profiledir)
+      for name,p in self.profiles.items():
+        p.dump_stats(os.path.join(self.profiledir,'%s.prof' % name))
+    self.detach()
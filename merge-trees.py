@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# merge-trees.py
+#
+# Merge git trees into one and print its SHA1. Every argument is a
+# tree-ish, optionally preceded by the directory PATH= it is to appear
+# at in the result, e.g.
+#
+#   merge-trees.py base src=library:src build/pkgs/foo=packages/foo:build/pkgs/foo
+#
+# Entries present in several of the trees have to be the same object
+# or trees themselves, which are merged recursively. Tree-ishs that do
+# not exist are skipped. All trees are read through one
+# git cat-file --batch and the merged ones written through one
+# git mktree --batch, so only trees present in more than one input are
+# ever read or written.
+
+from optparse import OptionParser
+import subprocess
+import sys
+
+class Tree(object):
+  """A tree being merged: name -> [mode,sha1] or Tree"""
+
+  def __init__(self,entries=None):
+    self.entries=entries or {}
+
+class Repo(object):
+  def __init__(self,missing=False):
+    self.cat=subprocess.Popen(['git','cat-file','--batch'],
+        stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    args=['git','mktree','-z','--batch']
+    if missing:
+      args.append('--missing')
+    self.mktree=subprocess.Popen(args,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+
+  def read(self,name):
+    """Return (sha1,type,contents) of object name, None if missing"""
+    self.cat.stdin.write(name+'\n')
+    self.cat.stdin.flush()
+    header=self.cat.stdout.readline().split()
+    if header[-1]=='missing':
+      return None
+    sha1,type,size=header
+    data=self.cat.stdout.read(int(size))
+    self.cat.stdout.read(1)
+    return sha1,type,data
+
+  def read_tree(self,name):
+    """Return the Tree of tree-ish name, None if it is missing"""
+    o=self.read(name)
+    if o!=None and o[1]=='commit':
+      o=self.read(o[0]+'^{tree}')
+    if o==None:
+      return None
+    if o[1]!='tree':
+      sys.stderr.write('Error: %s is a %s, not a tree\n' % (name,o[1]))
+      sys.exit(1)
+    entries={}
+    data,i=o[2],0
+    while i<len(data):
+      sp=data.index(' ',i)
+      nul=data.index('\0',sp)
+      entries[data[sp+1:nul]]=[data[i:sp],data[nul+1:nul+21].encode('hex')]
+      i=nul+21
+    return Tree(entries)
+
+  def write_tree(self,tree):
+    """Write tree and the merged trees below it, return its SHA1"""
+    lines=[]
+    for name,e in sorted(tree.entries.items()):
+      if isinstance(e,Tree):
+        e=['40000',self.write_tree(e)]
+      lines.append('%s %s %s\t%s\0' % (e[0],object_type(e[0]),e[1],name))
+    self.mktree.stdin.write(''.join(lines)+'\0')
+    self.mktree.stdin.flush()
+    return self.mktree.stdout.readline().strip()
+
+  def close(self):
+    self.cat.stdin.close()
+    self.mktree.stdin.close()
+    return self.cat.wait()==0 and self.mktree.wait()==0
+
+def object_type(mode):
+  if mode=='40000' or mode=='040000':
+    return 'tree'
+  if mode=='160000':
+    return 'commit'
+  return 'blob'
+
+def subtree(repo,tree,name):
+  """Return entry name of tree as a Tree, reading it if need be"""
+  e=tree.entries.get(name)
+  if isinstance(e,Tree):
+    return e
+  t=Tree()
+  if e!=None:
+    if object_type(e[0])!='tree':
+      return None
+    t=repo.read_tree(e[1])
+  tree.entries[name]=t
+  return t
+
+def merge(repo,tree,other,path):
+  """Merge the entries of Tree other into Tree tree"""
+  for name,e in other.entries.items():
+    mine=tree.entries.get(name)
+    if mine==None:
+      tree.entries[name]=e
+    elif not isinstance(mine,Tree) and not isinstance(e,Tree) and mine[1]==e[1]:
+      continue
+    else:
+      if not isinstance(e,Tree):
+        if object_type(e[0])!='tree':
+          e=None
+        else:
+          e=repo.read_tree(e[1])
+      t=subtree(repo,tree,name)
+      if t==None or e==None:
+        sys.stderr.write('Error: conflicting entries for %s%s\n' % (path,name))
+        sys.exit(1)
+      merge(repo,t,e,path+name+'/')
+
+def graft(repo,root,path,treeish):
+  """Merge tree-ish into directory path of Tree root"""
+  other=repo.read_tree(treeish)
+  if other==None:
+    return
+  tree=root
+  for name in [p for p in path.split('/') if p]:
+    tree=subtree(repo,tree,name)
+    if tree==None:
+      sys.stderr.write('Error: %s is not a directory\n' % path)
+      sys.exit(1)
+  merge(repo,tree,other,path and path.rstrip('/')+'/')
+
+if __name__=='__main__':
+  parser=OptionParser(usage='%prog [--missing] [PATH=]TREEISH...')
+  parser.add_option('--missing',action='store_true',dest='missing',
+      default=False,help='Pass --missing to git mktree')
+  (options,args)=parser.parse_args()
+
+  repo=Repo(options.missing)
+  root=Tree()
+  for arg in args:
+    path,treeish='',arg
+    if '=' in arg:
+      path,treeish=arg.split('=',1)
+    graft(repo,root,path,treeish)
+  sha1=repo.write_tree(root)
+  if not repo.close() or not sha1:
+    sys.exit(1)
+  print sha1
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# post-process.py
+#
+# Post-process the consolidated repo in the current directory as its
+# RULES file says, committing on top of HEAD. Every line of RULES
+# (other than empty ones and comments starting with #) is one of
+#
+#   rm-name PATTERN [DIR]    remove the files below DIR (default: all)
+#                            whose name matches glob PATTERN
+#   rm PATH                  remove file PATH or everything below it
+#   mv FROM TO               move file or directory FROM to TO
+#   gitignore NAME DIR       add gitignore-NAME, sorted, as DIR/.gitignore
+#   file NAME PATH [MODE]    add NAME as PATH, with octal MODE
+#   patch NAME               apply NAME.patch with git am
+#   commit MESSAGE           commit the changes since the last commit
+#
+# NAME is a file next to RULES. In RULES and those files, __CONSTANT__
+# stands for the value of environment variable CONSTANT, for all names
+# listed in $SAGE_CONSTANTS (see configuration.sh).
+#
+# HEAD's tree is listed once and all commits are made through one
+# git fast-import, the index and work tree being updated at the end;
+# only a patch needs them updated before it is applied.
+
+from optparse import OptionParser
+import fnmatch
+import os
+import posixpath
+import subprocess
+import sys
+
+def git(*args):
+  """Return the output of git command args, exit if it fails"""
+  p=subprocess.Popen(('git',)+args,stdout=subprocess.PIPE)
+  out=p.communicate()[0]
+  if p.returncode!=0:
+    sys.stderr.write('Error: git %s failed\n' % ' '.join(args))
+    sys.exit(1)
+  return out
+
+def read_tree(rev):
+  """Return the files of commit rev as path -> [mode,sha1]"""
+  files={}
+  for entry in git('ls-tree','-r','-z','--full-tree',rev).split('\0'):
+    if entry:
+      info,path=entry.split('\t',1)
+      mode,type,sha1=info.split()
+      files[path]=[mode,sha1]
+  return files
+
+def substitute(text):
+  """Replace the __CONSTANT__s in text by their values"""
+  for name in os.environ.get('SAGE_CONSTANTS','').split():
+    text=text.replace('__%s__' % name,os.environ.get(name,''))
+  return text
+
+def below(path,dir):
+  """Whether path is dir or below it"""
+  return dir in ('','.') or path==dir or path.startswith(dir+'/')
+
+class Session(object):
+  """The commits being made on top of HEAD through git fast-import"""
+
+  ref='refs/post-process/head'
+
+  def __init__(self):
+    self.head=git('rev-parse','--verify','HEAD').strip()
+    self.files=read_tree(self.head)
+    self.committed=dict(self.files)
+    self.mark=0
+    self.count=0
+    self.author=git('var','GIT_AUTHOR_IDENT').strip()
+    self.committer=git('var','GIT_COMMITTER_IDENT').strip()
+    self.gfi=subprocess.Popen(['git','fast-import','--quiet'],stdin=subprocess.PIPE)
+    self.out=self.gfi.stdin
+
+  def data(self,text):
+    self.out.write('data %d\n%s\n' % (len(text),text))
+
+  def add(self,path,text,mode='100644'):
+    """Add a file with contents text"""
+    self.mark+=1
+    self.out.write('blob\nmark :%d\n' % self.mark)
+    self.data(text)
+    self.files[path]=[mode,':%d' % self.mark]
+
+  def commit(self,message):
+    """Commit the changes since the last commit, if any"""
+    removed=[p for p in self.committed if p not in self.files]
+    changed=[p for p in self.files if self.committed.get(p)!=self.files[p]]
+    if not removed and not changed:
+      sys.stderr.write('Nothing to commit for %s\n' % message)
+      return
+    self.out.write('commit %s\n' % self.ref)
+    self.out.write('author %s\ncommitter %s\n' % (self.author,self.committer))
+    self.data(message+'\n')
+    if self.count==0:
+      self.out.write('from %s\n' % self.head)
+    for path in sorted(removed):
+      self.out.write('D %s\n' % path)
+    for path in sorted(changed):
+      self.out.write('M %s %s %s\n' % (self.files[path][0],self.files[path][1],path))
+    self.out.write('\n')
+    self.committed=dict(self.files)
+    self.count+=1
+    sys.stderr.write('%s: %d removed, %d added or changed\n' % (message,len(removed),len(changed)))
+
+  def close(self):
+    """Finish the commits and bring HEAD, index and work tree to them"""
+    if self.files!=self.committed:
+      sys.stderr.write('Warning: changes after the last commit are dropped\n')
+    self.out.close()
+    if self.gfi.wait()!=0:
+      sys.stderr.write('Error: git fast-import failed\n')
+      sys.exit(1)
+    if self.count==0:
+      return
+    new=git('rev-parse','--verify',self.ref).strip()
+    # read-tree wants the index's stat data up to date
+    subprocess.call(['git','update-index','-q','--refresh'])
+    git('read-tree','-m','-u',self.head,new)
+    git('update-ref','-m','post-process','HEAD',new,self.head)
+    git('update-ref','-d',self.ref)
+
+class Rules(object):
+  def __init__(self,filename):
+    self.filename=filename
+    self.dir=os.path.dirname(filename)
+    self.session=None
+
+  def read(self,name):
+    """Return the contents of file name next to the rules"""
+    f=open(os.path.join(self.dir,name),'r')
+    text=substitute(f.read())
+    f.close()
+    return text
+
+  def remove(self,match,what):
+    files=self.session.files
+    paths=[p for p in files if match(p)]
+    if not paths:
+      sys.stderr.write('Warning: nothing matches %s\n' % what)
+    for p in paths:
+      del files[p]
+
+  def move(self,src,dst):
+    files=self.session.files
+    if any(p.startswith(dst+'/') for p in files):
+      dst=posixpath.join(dst,posixpath.basename(src))
+    paths=[p for p in files if below(p,src)]
+    if not paths:
+      sys.stderr.write('Warning: nothing to move in %s\n' % src)
+    for p in paths:
+      files[dst+p[len(src):]]=files.pop(p)
+
+  def apply(self,line):
+    cmd,args=line.split(None,1)[0],line.split()[1:]
+    s=self.session
+    if cmd=='rm-name' and len(args) in (1,2):
+      dir=(args[1:] or [''])[0]
+      self.remove(lambda p: below(p,dir) and
+          fnmatch.fnmatchcase(posixpath.basename(p),args[0]),args[0])
+    elif cmd=='rm' and len(args)==1:
+      self.remove(lambda p: below(p,args[0]),args[0])
+    elif cmd=='mv' and len(args)==2:
+      self.move(args[0],args[1])
+    elif cmd=='gitignore' and len(args)==2:
+      lines=sorted(self.read('gitignore-'+args[0]).splitlines())
+      s.add(posixpath.normpath(posixpath.join(args[1],'.gitignore')),
+          ''.join([l+'\n' for l in lines]))
+    elif cmd=='file' and len(args) in (2,3):
+      mode='100644'
+      if len(args)==3 and int(args[2],8)&0111:
+        mode='100755'
+      s.add(args[1],self.read(args[0]),mode)
+    elif cmd=='patch' and len(args)==1:
+      # git am needs the index and work tree
+      s.close()
+      p=subprocess.Popen(['git','am'],stdin=subprocess.PIPE)
+      p.communicate(self.read(args[0]+'.patch'))
+      if p.returncode!=0:
+        sys.stderr.write('Error: applying %s failed\n' % args[0])
+        sys.exit(1)
+      self.session=Session()
+    elif cmd=='commit' and len(args)>0:
+      s.commit(line.split(None,1)[1])
+    else:
+      return False
+    return True
+
+  def run(self):
+    f=open(self.filename,'r')
+    lines=substitute(f.read()).splitlines()
+    f.close()
+    self.session=Session()
+    for n,line in enumerate(lines):
+      line=line.strip()
+      if line=='' or line.startswith('#'):
+        continue
+      if not self.apply(line):
+        sys.stderr.write('Error: invalid rule in [%s], line %d\n' % (self.filename,n+1))
+        sys.exit(1)
+    self.session.close()
+
+if __name__=='__main__':
+  parser=OptionParser(usage='%prog RULES')
+  (options,args)=parser.parse_args()
+  if len(args)!=1:
+    parser.error('need a rules file')
+  Rules(args[0]).run()